@@ -20,6 +20,7 @@ setuptools.setup(name='easyipc',
     package_dir={'easyipc' : 'src'}, 
     test_suite = 'tests',
     install_requires = ['numpy'],
+    python_requires='>=3.9',
     long_description=long_description,
     long_description_content_type='text/markdown',             
     classifiers=[
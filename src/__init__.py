@@ -2,4 +2,8 @@
 # -*- coding: utf-8 -*-
 import sys
 __version__ = '0.1.0'
-from .easyipc import Pipe
+from .easyipc import Pipe, SharedMemoryPipe, AsyncPipe, UnixSocketPipe, PipeServer, PipeClient, \
+    TcpPipe, TcpPipePool, PipeSelector, wait, RpcServer, RpcClient, \
+    Broadcaster, Subscriber, Codec, register_codec, \
+    BufferAdapter, register_buffer_adapter, \
+    Serializer, register_serializer, unregister_serializer, struct_serializer, msgpack_serializer
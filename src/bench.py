@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+@brief   Benchmark of the transports of EasyIPC. Run it with 'python -m easyipc.bench'.
+@details For each transport and payload size, a child process echoes the messages sent
+         by the parent, which times each round trip with time.perf_counter_ns(). The
+         transports of EasyIPC are compared against multiprocessing.Pipe and a
+         multiprocessing.shared_memory segment signalled through a multiprocessing.Pipe.
+         The percentiles of the round trips of pipe_whatever and pipe_whatever_spin 
+         compare blocking reads with the busy-poll mode of Pipe (the 'spin' option).
+         The results can be saved as JSON to compare versions.
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+from . import __version__
+from .easyipc import Pipe, SharedMemoryPipe, UnixSocketPipe
+
+
+class Transport:
+    """
+    @brief Both ends of a transport. The object is created in the parent process, and after
+           the fork each process calls open() with its role.
+    """
+    name = None
+
+    def __init__(self, size):
+        self.size = size
+        self.pipe_name = 'easyipc_bench_' + str(os.getpid()) + '_' + self.name
+
+    def open(self, server):
+        pass
+
+    def send(self, data):
+        raise NotImplementedError
+
+    def recv(self):
+        raise NotImplementedError
+
+    def done(self, data):
+        """
+        @brief Called when a received message is not needed anymore.
+        """
+        pass
+
+    def close(self, server=False):
+        pass
+
+
+class PipeArray(Transport):
+    name = 'pipe_array'
+
+    def open(self, server):
+        self.pipe = Pipe(self.pipe_name)
+        self.pipe.listen() if server else self.pipe.connect()
+
+    def send(self, data):
+        self.pipe.send_array(data)
+
+    def recv(self):
+        return self.pipe.recv_array()
+
+    def close(self, server=False):
+        self.pipe.cleanup()
+        for name in glob.glob(os.path.join(tempfile.gettempdir(), '.' + self.pipe_name + '_*')):
+            try:
+                os.unlink(name)
+            except FileNotFoundError:
+                pass
+
+
+class PipeWhatever(PipeArray):
+    name = 'pipe_whatever'
+
+    def send(self, data):
+        self.pipe.send_whatever(data)
+
+    def recv(self):
+        return self.pipe.recv_whatever()
+
+
+class PipeWhateverSpin(PipeWhatever):
+    name = 'pipe_whatever_spin'
+    spin = 100e-6
+
+    def open(self, server):
+        self.pipe = Pipe(self.pipe_name, spin=self.spin)
+        self.pipe.listen() if server else self.pipe.connect()
+
+
+class SharedMemoryPipeArray(PipeArray):
+    name = 'shm_pipe_array'
+
+    def open(self, server):
+        self.pipe = SharedMemoryPipe(self.pipe_name, slots=2, slot_size=max(self.size, 1))
+        self.pipe.listen() if server else self.pipe.connect()
+
+    def done(self, data):
+        self.pipe.release(data)
+
+
+class UnixSocketPipeArray(PipeArray):
+    name = 'unix_socket_array'
+
+    def open(self, server):
+        self.pipe = UnixSocketPipe(self.pipe_name)
+        self.pipe.listen() if server else self.pipe.connect()
+
+
+class MultiprocessingPipe(Transport):
+    name = 'mp_pipe'
+
+    def __init__(self, size):
+        super().__init__(size)
+        self.conns = multiprocessing.Pipe()
+
+    def open(self, server):
+        self.conn = self.conns[0] if server else self.conns[1]
+
+    def send(self, data):
+        self.conn.send_bytes(data)
+
+    def recv(self):
+        return np.frombuffer(self.conn.recv_bytes(), dtype=np.uint8)
+
+    def close(self, server=False):
+        for conn in self.conns:
+            conn.close()
+
+
+class MultiprocessingSharedMemory(MultiprocessingPipe):
+    name = 'mp_shared_memory'
+
+    def __init__(self, size):
+        super().__init__(size)
+        self.segments = [shared_memory.SharedMemory(create=True, size=max(size, 1))
+            for _ in range(2)]
+
+    def open(self, server):
+        super().open(server)
+        segments = self.segments[::-1] if server else self.segments
+        self.send_buf = np.ndarray(self.size, dtype=np.uint8, buffer=segments[0].buf)
+        self.recv_buf = np.ndarray(self.size, dtype=np.uint8, buffer=segments[1].buf)
+
+    def send(self, data):
+        np.copyto(self.send_buf, data)
+        self.conn.send_bytes(b'')
+
+    def recv(self):
+        self.conn.recv_bytes()
+        return self.recv_buf
+
+    def close(self, server=False):
+        super().close()
+        self.send_buf = self.recv_buf = None
+        for segment in self.segments:
+            segment.close()
+            if not server:
+                segment.unlink()
+
+
+TRANSPORTS = {t.name: t for t in (PipeArray, PipeWhatever, PipeWhateverSpin, 
+    SharedMemoryPipeArray, UnixSocketPipeArray, MultiprocessingPipe, MultiprocessingSharedMemory)}
+
+
+def echo(transport, iterations):
+    """
+    @brief Server side of the benchmark, sends back every message it receives.
+    """
+    transport.open(server=True)
+    for _ in range(iterations):
+        data = transport.recv()
+        transport.send(data)
+        transport.done(data)
+    del data
+    transport.close(server=True)
+
+
+def measure(name, size, iterations, warmup=1):
+    """
+    @brief      Times round trips of a payload of 'size' random bytes.
+    @param[in]  name        Name of the transport, see TRANSPORTS.
+    @param[in]  size        Size of the payload in bytes.
+    @param[in]  iterations  Number of round trips timed.
+    @param[in]  warmup      Number of round trips done before timing.
+    @returns    a dictionary with the results.
+    """
+    transport = TRANSPORTS[name](size)
+    payload = np.random.randint(0, 256, size, dtype=np.uint8)
+    context = multiprocessing.get_context('fork')
+    server = context.Process(target=echo, args=(transport, warmup + iterations), daemon=True)
+    server.start()
+    try:
+        transport.open(server=False)
+        times = np.empty(iterations, dtype=np.int64)
+        for i in range(-warmup, iterations):
+            tic = time.perf_counter_ns()
+            transport.send(payload)
+            data = transport.recv()
+            toc = time.perf_counter_ns()
+            transport.done(data)
+            if i >= 0:
+                times[i] = toc - tic
+        del data
+        server.join()
+    finally:
+        if server.is_alive():
+            server.kill()
+        transport.close()
+
+    # Each round trip moves two messages of 'size' bytes
+    elapsed = times.sum() / 1e9
+    p50, p99, p999 = np.percentile(times, [50, 99, 99.9]) / 1e3
+    return {
+        'transport': name,
+        'size': size,
+        'iterations': iterations,
+        'throughput_MBps': 2 * size * iterations / elapsed / 1e6,
+        'messages_per_s': 2 * iterations / elapsed,
+        'rtt_p50_us': p50,
+        'rtt_p99_us': p99,
+        'rtt_p999_us': p999,
+    }
+
+
+def sizes(min_size=64, max_size=1 << 30, factor=4):
+    """
+    @returns the payload sizes of the sweep, from 'min_size' to 'max_size' bytes.
+    """
+    size = min_size
+    while size <= max_size:
+        yield size
+        size *= factor
+
+
+def run(transports=None, min_size=64, max_size=1 << 30, bytes_per_point=1 << 30,
+        min_iterations=5, max_iterations=2000, log=None):
+    """
+    @brief      Runs the whole sweep.
+    @param[in]  transports       List of transport names, all of them by default.
+    @param[in]  bytes_per_point  Number of bytes sent per transport and size, it sets the
+                                 number of round trips within the limits below.
+    @param[in]  log              File where a line per result is printed, if any.
+    @returns    a dictionary with the environment and the list of results.
+    """
+    results = []
+    for size in sizes(min_size, max_size):
+        iterations = int(min(max_iterations, max(min_iterations, bytes_per_point // size)))
+        for name in transports or TRANSPORTS:
+            result = measure(name, size, iterations)
+            results.append(result)
+            if log is not None:
+                log.write('{transport:>18} {size:>11} B {throughput_MBps:>10.1f} MB/s '
+                    '{messages_per_s:>10.0f} msg/s  p50 {rtt_p50_us:>10.1f} us  '
+                    'p99 {rtt_p99_us:>10.1f} us  p999 {rtt_p999_us:>10.1f} us\n'.format(**result))
+                log.flush()
+    return {
+        'easyipc': __version__,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'date': datetime.datetime.now().isoformat(),
+        'results': results,
+    }
+
+
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if text[-1].upper() in units:
+        return int(text[:-1]) * units[text[-1].upper()]
+    return int(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the transports of EasyIPC.')
+    parser.add_argument('--transports', nargs='+', choices=list(TRANSPORTS),
+        help='Transports to run, all of them by default.')
+    parser.add_argument('--min-size', type=parse_size, default=64,
+        help='Smallest payload, e.g. 64, 4K or 1M.')
+    parser.add_argument('--max-size', type=parse_size, default=1 << 30,
+        help='Largest payload, e.g. 1M or 1G.')
+    parser.add_argument('--bytes-per-point', type=parse_size, default=1 << 30,
+        help='Bytes sent per transport and size.')
+    parser.add_argument('--max-iterations', type=int, default=2000,
+        help='Maximum number of round trips per transport and size.')
+    parser.add_argument('--output', help='Path of the JSON file with the results.')
+    args = parser.parse_args()
+
+    report = run(args.transports, args.min_size, args.max_size, args.bytes_per_point,
+        max_iterations=args.max_iterations, log=sys.stdout)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
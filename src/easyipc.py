@@ -3,12 +3,16 @@
 """
 @brief   Easy-to-use IPC module. Check the examples in 'server.py' and 'client.py'.
 @details You can send any object serializable by pickle and a bit more efficiently
-         numpy.ndarray objects. DatagramIPC is implemented using UDP, and it is 
-         usually slower that the one implemented with FIFOs, Pipe.
+         numpy.ndarray objects. Pipe uses FIFOs and is the fastest between two 
+         processes of the same machine, TcpPipe has the same API over TCP to reach 
+         other machines.
 @author  Luis C. Garcia Peraza Herrera (luiscarlos.gph@gmail.com).
 @date    24 June 2020.
 """
 
+import ast
+import fcntl
+import array
 import socket
 import struct
 import numpy as np
@@ -16,9 +20,36 @@ import atexit
 import pickle
 import os
 import os.path
+import sys
 import stat
+import mmap
 import select
 import tempfile
+import time
+import math
+import collections
+import asyncio
+import uuid
+import itertools
+import threading
+import queue
+import concurrent.futures
+import zlib
+import dataclasses
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class BaseIPC:
@@ -44,10 +75,456 @@ class BaseIPC:
         raise NotImplemented()
 
 
+class BufferPool:
+
+    def __init__(self, max_bytes):
+        """
+        @brief      Keeps arrays that are not needed anymore so that they can be reused 
+                    to receive arrays of the same shape and dtype.
+        @details    When the pool is full, the arrays of the least recently used 
+                    (shape, dtype) are discarded first.
+        @param[in]  max_bytes  Maximum number of bytes kept in the pool.
+        @returns    nothing.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.buffers = collections.OrderedDict()
+
+
+    def get(self, shape, dtype):
+        """
+        @brief   Takes an array out of the pool.
+        @returns an array of the given shape and dtype taken from the pool, or None if 
+                 there is none available.
+        """
+        key = (tuple(shape), np.dtype(dtype))
+        arrays = self.buffers.get(key)
+        if not arrays:
+            return None
+        data = arrays.pop()
+        if arrays:
+            self.buffers.move_to_end(key)
+        else:
+            del self.buffers[key]
+        self.nbytes -= data.nbytes
+        return data
+
+
+    def put(self, data):
+        """
+        @brief      Adds an array to the pool. Arrays that cannot be used to receive data
+                    (views, read-only or non-contiguous arrays) and arrays that are already
+                    in the pool are ignored.
+        @param[in]  data  Numpy.ndarray that the caller will not use anymore.
+        @returns    nothing.
+        """
+        if data.base is not None or not data.flags.writeable or not data.flags.c_contiguous \
+                or data.nbytes > self.max_bytes:
+            return
+
+        # An array that is already in the pool would be handed out twice
+        key = (data.shape, data.dtype)
+        if any(data is array for array in self.buffers.get(key, [])):
+            return
+        self.buffers.setdefault(key, []).append(data)
+        self.buffers.move_to_end(key)
+        self.nbytes += data.nbytes
+
+        # Evict the arrays of the least recently used shapes and dtypes
+        while self.nbytes > self.max_bytes:
+            key, arrays = next(iter(self.buffers.items()))
+            self.nbytes -= arrays.pop(0).nbytes
+            if not arrays:
+                del self.buffers[key]
+
+
+class Codec:
+
+    def __init__(self, codec_id, name, compress, decompress_into):
+        """
+        @brief      Compression codec that can be used by Pipe (see register_codec).
+        @param[in]  codec_id         Number from 1 to 15 that identifies the codec in the
+                                     messages, same for both ends.
+        @param[in]  name             String used to choose the codec, e.g. 'zlib'.
+        @param[in]  compress         Function that takes a buffer and returns its 
+                                     compressed bytes.
+        @param[in]  decompress_into  Function that takes the compressed bytes and a 
+                                     writable buffer of bytes, and fills the buffer with 
+                                     the decompressed bytes. It raises IOError if they 
+                                     do not fit the buffer exactly.
+        @returns    nothing.
+        """
+        self.codec_id = codec_id
+        self.name = name
+        self.compress = compress
+        self.decompress_into = decompress_into
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """
+    @brief Makes a codec available to the Pipe objects of this process by id and by name.
+    """
+    if not 1 <= codec.codec_id <= 15:
+        raise ValueError('Codec ids go from 1 to 15.')
+    CODECS[codec.codec_id] = codec
+    CODECS[codec.name] = codec
+
+
+def copy_chunks_into(chunks, dst):
+    """
+    @brief      Copies an iterable of byte chunks into 'dst' one after the other.
+    @returns    nothing, raises IOError if the chunks do not fill 'dst' exactly.
+    """
+    dst = memoryview(dst).cast('B')
+    pos = 0
+    for chunk in chunks:
+        if pos + len(chunk) > dst.nbytes:
+            raise IOError('The decompressed data is larger than expected.')
+        dst[pos:pos + len(chunk)] = chunk
+        pos += len(chunk)
+    if pos != dst.nbytes:
+        raise IOError('The decompressed data is smaller than expected.')
+
+
+def zlib_decompress_into(src, dst, chunk_size=1024 * 1024):
+    def chunks():
+        decompressor = zlib.decompressobj()
+        data = src
+        while not decompressor.eof:
+            chunk = decompressor.decompress(data, chunk_size)
+            data = decompressor.unconsumed_tail
+            if not chunk and not data:
+                break
+            yield chunk
+    copy_chunks_into(chunks(), dst)
+
+
+register_codec(Codec(1, 'zlib', lambda buf: zlib.compress(buf, 1), zlib_decompress_into))
+
+if lz4 is not None:
+    def lz4_decompress_into(src, dst, chunk_size=1024 * 1024):
+        def chunks():
+            decompressor = lz4.frame.LZ4FrameDecompressor()
+            data = src
+            while not decompressor.eof:
+                chunk = decompressor.decompress(data, max_length=chunk_size)
+                data = b''
+                if not chunk and decompressor.needs_input:
+                    break
+                yield chunk
+        copy_chunks_into(chunks(), dst)
+
+    register_codec(Codec(2, 'lz4', lambda buf: lz4.frame.compress(buf), lz4_decompress_into))
+
+if zstandard is not None:
+    def zstd_decompress_into(src, dst):
+        dst = memoryview(dst).cast('B')
+        pos = 0
+        with zstandard.ZstdDecompressor().stream_reader(src) as reader:
+            while pos < dst.nbytes:
+                nbytes = reader.readinto(dst[pos:])
+                if nbytes == 0:
+                    raise IOError('The decompressed data is smaller than expected.')
+                pos += nbytes
+            if reader.read(1):
+                raise IOError('The decompressed data is larger than expected.')
+
+    register_codec(Codec(3, 'zstd', lambda buf: zstandard.ZstdCompressor(level=1).compress(buf), 
+        zstd_decompress_into))
+
+
+class BufferAdapter:
+
+    def __init__(self, name, accepts, to_buffer, from_buffer):
+        """
+        @brief      Converts objects of a type to a buffer and back (see Pipe.send_buffer).
+        @param[in]  name         String that identifies the adapter, same for both ends.
+        @param[in]  accepts      Function that returns True if the object is of this type.
+        @param[in]  to_buffer    Function that takes the object and returns a tuple 
+                                 (buffer, metadata), where the buffer is a C-contiguous 
+                                 object supporting the buffer protocol and the metadata is
+                                 a small object serialisable by pickle.
+        @param[in]  from_buffer  Function that takes a numpy array of uint8 with the bytes
+                                 of the buffer and the metadata, and returns the object.
+        @returns    nothing.
+        """
+        self.name = name
+        self.accepts = accepts
+        self.to_buffer = to_buffer
+        self.from_buffer = from_buffer
+
+
+BUFFER_ADAPTERS = collections.OrderedDict()
+
+
+def register_buffer_adapter(adapter):
+    """
+    @brief Makes an adapter available to send_buffer() and recv_buffer(). Adapters are 
+           tried in the order they were registered, the last ones first.
+    """
+    BUFFER_ADAPTERS[adapter.name] = adapter
+    BUFFER_ADAPTERS.move_to_end(adapter.name, last=False)
+
+
+def array_to_buffer(data):
+    data = np.ascontiguousarray(data)
+    if data.dtype.hasobject:
+        raise ValueError('Arrays of Python objects do not support the buffer protocol.')
+    return data.reshape(-1).view(np.uint8), (data.dtype, data.shape)
+
+
+def array_from_buffer(buf, meta):
+    dtype, shape = meta
+    return buf.view(dtype).reshape(shape)
+
+
+def memoryview_from_buffer(buf, meta):
+    fmt, shape = meta
+    view = memoryview(buf)
+    try:
+        return view.cast(fmt, shape)
+    except (TypeError, ValueError):
+        # Formats that memoryview cannot cast to are returned as bytes
+        return view
+
+
+def is_instance_of(module_name, class_name):
+    """
+    @returns a function that checks if an object is an instance of module_name.class_name,
+             without importing the module if the object cannot be one.
+    """
+    def accepts(obj):
+        module = sys.modules.get(module_name)
+        return module is not None and isinstance(obj, getattr(module, class_name))
+    return accepts
+
+
+def torch_from_buffer(buf, meta):
+    import torch
+    return torch.from_numpy(array_from_buffer(buf, meta))
+
+
+def pil_from_buffer(buf, meta):
+    from PIL import Image
+    return Image.fromarray(array_from_buffer(buf, meta))
+
+
+def array_array_from_buffer(buf, typecode):
+    data = array.array(typecode)
+    data.frombytes(buf)
+    return data
+
+
+# Generic buffers first, the more specific adapters are tried before them
+register_buffer_adapter(BufferAdapter('memoryview', lambda obj: True, 
+    lambda obj: (memoryview(obj), (memoryview(obj).format, memoryview(obj).shape)), 
+    memoryview_from_buffer))
+register_buffer_adapter(BufferAdapter('bytes', lambda obj: isinstance(obj, bytes), 
+    lambda obj: (obj, None), lambda buf, meta: buf.tobytes()))
+register_buffer_adapter(BufferAdapter('bytearray', lambda obj: isinstance(obj, bytearray), 
+    lambda obj: (obj, None), lambda buf, meta: bytearray(buf)))
+register_buffer_adapter(BufferAdapter('array', lambda obj: isinstance(obj, array.array), 
+    lambda obj: (obj, obj.typecode), array_array_from_buffer))
+register_buffer_adapter(BufferAdapter('numpy', lambda obj: isinstance(obj, np.ndarray), 
+    array_to_buffer, array_from_buffer))
+register_buffer_adapter(BufferAdapter('torch', is_instance_of('torch', 'Tensor'), 
+    lambda obj: array_to_buffer(obj.detach().cpu().numpy()), torch_from_buffer))
+register_buffer_adapter(BufferAdapter('pil', is_instance_of('PIL.Image', 'Image'), 
+    lambda obj: array_to_buffer(np.asarray(obj)), pil_from_buffer))
+
+
+class Serializer:
+
+    def __init__(self, tag, cls, encode, decode):
+        """
+        @brief      Compact encoding of the objects of a type, used by send_whatever() 
+                    instead of pickle (see register_serializer).
+        @details    The message carries the tag, so the other end decodes it without pickle,
+                    and peers written in other languages can read it.
+        @param[in]  tag     Number from 1 to 65535 that identifies the serializer in the 
+                            messages, same for both ends.
+        @param[in]  cls     Type of the objects, subclasses are pickled.
+        @param[in]  encode  Function that takes an object and returns its bytes. If it 
+                            raises TypeError, ValueError, OverflowError or struct.error, 
+                            the object is pickled.
+        @param[in]  decode  Function that takes a memoryview of the bytes and returns the 
+                            object.
+        @returns    nothing.
+        """
+        self.tag = tag
+        self.cls = cls
+        self.encode = encode
+        self.decode = decode
+
+
+SERIALIZERS = {}
+
+
+def register_serializer(serializer):
+    """
+    @brief Makes a serializer available to the Pipe objects of this process by tag and by 
+           type. A type registered again replaces its previous serializer.
+    """
+    if not 1 <= serializer.tag <= 0xffff:
+        raise ValueError('Serializer tags go from 1 to 65535.')
+    SERIALIZERS[serializer.tag] = serializer
+    SERIALIZERS[serializer.cls] = serializer
+
+
+def unregister_serializer(serializer):
+    """
+    @brief Undoes register_serializer(). Objects of its type are pickled again and its tag 
+           is no longer decoded. Does nothing if the serializer is not registered.
+    """
+    if SERIALIZERS.get(serializer.tag) is serializer:
+        del SERIALIZERS[serializer.tag]
+    if SERIALIZERS.get(serializer.cls) is serializer:
+        del SERIALIZERS[serializer.cls]
+
+
+def struct_serializer(tag, cls, fmt, fields=None):
+    """
+    @brief      Serializer of a fixed struct layout, e.g. for a dataclass of scalars.
+    @param[in]  fmt     Format of struct.pack(), e.g. '<qd8s'.
+    @param[in]  fields  Names of the attributes packed in order, by default the fields of 
+                        the dataclass. The class is built with them as positional arguments.
+    @returns    a Serializer.
+    """
+    layout = struct.Struct(fmt)
+    names = fields if fields is not None else [f.name for f in dataclasses.fields(cls)]
+    return Serializer(tag, cls, lambda obj: layout.pack(*[getattr(obj, n) for n in names]),
+        lambda buf: cls(*layout.unpack(buf)))
+
+
+def msgpack_serializer(tag, cls=dict):
+    """
+    @brief      Serializer with msgpack, e.g. for dictionaries of scalars and strings. 
+    @details    Msgpack does not tell tuples from lists, both are received as lists, and 
+                objects it does not know (e.g. numpy arrays) are pickled.
+    @returns    a Serializer, raises ImportError if msgpack is not installed.
+    """
+    if msgpack is None:
+        raise ImportError('Msgpack is not installed.')
+    def decode(buf):
+        obj = msgpack.unpackb(buf, strict_map_key=False)
+        return obj if type(obj) is cls else cls(obj)
+    return Serializer(tag, cls, msgpack.packb, decode)
+
+
+class PipeStats:
+
+    COUNTERS = ('messages_sent', 'messages_received', 'bytes_sent', 'bytes_received', 
+        'write_calls', 'read_calls', 'short_writes', 'short_reads', 'spin_hits', 
+        'spin_misses', 'credit_exhausted', 'messages_dropped')
+    TIMERS = ('write_blocked_ns', 'read_blocked_ns', 'pickle_ns', 'unpickle_ns', 
+        'header_encode_ns', 'header_decode_ns', 'wait_ns', 'credit_wait_ns')
+
+    def __init__(self, hook=None):
+        """
+        @brief      Counters and timers of a Pipe (see the 'stats' option of Pipe).
+        @details    The time of each timed operation is also added to a histogram with
+                    power-of-two buckets, and passed to 'hook' if given, e.g. to feed the
+                    histograms of a monitoring system.
+        @param[in]  hook  Function called as hook(timer name, nanoseconds).
+        @returns    nothing.
+        """
+        self.hook = hook
+        self.values = dict.fromkeys(PipeStats.COUNTERS + PipeStats.TIMERS, 0)
+        self.buckets = {name: collections.Counter() for name in PipeStats.TIMERS}
+
+
+    def count(self, name, value=1):
+        self.values[name] += value
+
+
+    def time(self, name, elapsed_ns):
+        self.values[name] += elapsed_ns
+        self.buckets[name][elapsed_ns.bit_length()] += 1
+        if self.hook is not None:
+            self.hook(name, elapsed_ns)
+
+
+    def io(self, direction, requested, done, elapsed_ns):
+        """
+        @brief Records a read or write system call ('direction' is 'read' or 'write').
+        """
+        self.values[direction + '_calls'] += 1
+        self.values['bytes_sent' if direction == 'write' else 'bytes_received'] += done
+        if done < requested:
+            self.values['short_' + direction + 's'] += 1
+        self.time(direction + '_blocked_ns', elapsed_ns)
+
+
+    def snapshot(self):
+        """
+        @returns a dictionary with the current value of the counters and timers.
+        """
+        return dict(self.values)
+
+
+    def histograms(self):
+        """
+        @returns a dictionary {timer name: {bucket upper bound in ns: count}}.
+        """
+        return {name: {(1 << bits) - 1: n for bits, n in sorted(buckets.items())} 
+            for name, buckets in self.buckets.items()}
+
+
+class Striped:
+
+    def __init__(self, buf):
+        """
+        @brief      Marks the body of an array that is split among the stripes of a Pipe 
+                    (see the 'stripes' option of Pipe) instead of going whole through the 
+                    main pair of FIFOs.
+        @param[in]  buf  Object supporting the buffer protocol.
+        @returns    nothing.
+        """
+        self.buf = buf
+
+
 class Pipe(BaseIPC):
-    
+    # Buffers of at least this size are sent out of the pickle by send_whatever
+    oob_threshold = 64 * 1024
+
+    # Fixed part of the header of the arrays: version, flags, ndim and descriptor length
+    ARRAY_HEADER = struct.Struct('>BBHI')
+    ARRAY_HEADER_VERSION = 1
+    FORTRAN = 1
+    STRUCTURED = 2
+    CODEC_SHIFT = 4
+
+    # Top bit of the codec byte, which codec ids (1 to 15) never use, of the messages 
+    # encoded by a Serializer. The 24 bits of the number of buffers stay available.
+    SERIALIZED = 1 << 31
+
+    # Credit grant of the flow control: messages and bytes
+    GRANT = struct.Struct('>QQ')
+    UNLIMITED = 1 << 62
+
+    # Only buffers of at least this size are compressed, and only if compressing their 
+    # first compression_sample bytes gives at most compression_ratio of their size
+    compression_threshold = 4096
+    compression_sample = 64 * 1024
+    compression_ratio = 0.9
+
+    # Seconds cleanup() waits for the writer thread of send_async() to finish
+    close_timeout = 5
+
+    # Only the uncompressed bodies of at least this size are split among the stripes
+    stripe_threshold = 1024 * 1024
+
+    # Linux fcntl to set the capacity of a pipe, exported by the fcntl module from 3.10
+    F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
     #def __init__(self, read_pipe_name, write_pipe_name, lensize=8):
-    def __init__(self, pipe_name, lensize=8, header_len=128):
+    def __init__(self, pipe_name, lensize=8, header_len=128, pool_size=0, flush_bytes=0,
+            flush_delay=0.001, compression=None, stats=False, stats_hook=None, 
+            async_queue_size=64, backpressure='block', stripes=1, pipe_size=None, spin=0,
+            window_messages=0, window_bytes=0, credit_hook=None):
         """
         @brief      Easy to use wrapper for full-duplex IPC among two processes.
         @details    Two PIPEs are used for the task. They have to be inverted between
@@ -61,34 +538,312 @@ class Pipe(BaseIPC):
                                      size of the data (in bytes). This means you can 
                                      send packages of data of upto 2^64 bytes. That
                                      is a lot of data.
+        @param[in]  header_len       Number of bytes reserved for the header of the arrays.
+                                     Larger headers (many dimensions or structured dtypes)
+                                     are read with an extra system call.
+        @param[in]  pool_size        Maximum number of bytes kept by recycle() to receive
+                                     arrays. Zero disables the pool.
+        @param[in]  flush_bytes      If non-zero, send_whatever() queues the messages and 
+                                     writes them all at once when they reach this size, 
+                                     when the oldest one has waited 'flush_delay' seconds,
+                                     when flush() is called, or before receiving anything
+                                     (unless another thread is sending at that moment).
+        @param[in]  flush_delay      Maximum number of seconds a queued message waits.
+        @param[in]  compression      Name of the codec used to compress the arrays and the 
+                                     out-of-band buffers sent, 'zlib', 'lz4' or 'zstd' 
+                                     (the last two only if installed). None disables it.
+                                     Any codec is decompressed regardless of this option.
+        @param[in]  stats            If True, messages, bytes, system calls and the time 
+                                     spent in them, in pickle and in the array headers are 
+                                     recorded (see stats()). Off, it costs nothing.
+        @param[in]  stats_hook       Function called as stats_hook(timer name, nanoseconds) 
+                                     for each timed operation, to export histograms.
+        @param[in]  async_queue_size Maximum number of messages waiting to be written by 
+                                     send_async() and send_array_async().
+        @param[in]  backpressure     What send_async() and send_array_async() do when their 
+                                     queue is full: 'block' until there is room, 
+                                     'drop_oldest' cancels the oldest message waiting, and
+                                     'raise' raises BlockingIOError.
+        @param[in]  stripes          Number of pairs of FIFOs, both ends must use the same. 
+                                     With more than one, the body of large arrays is split 
+                                     in 'stripes' slices that are written and read in 
+                                     parallel by a pool of threads, one pair each.
+        @param[in]  pipe_size        Capacity in bytes requested for each FIFO with 
+                                     F_SETPIPE_SZ, 0 keeps the default of the system. By 
+                                     default, the maximum allowed to unprivileged users if 
+                                     there are stripes. Refusals are ignored.
+        @param[in]  spin             Seconds that the receiving methods keep polling the 
+                                     input pipe without sleeping before they block, e.g. 
+                                     20e-6. Messages that arrive within it skip the wake-up 
+                                     of the process, at the cost of a busy CPU meanwhile.
+                                     It only pays off if each process has a core to itself.
+                                     With 'stats', the time waited is in 'wait_ns' and the 
+                                     waits that ended while spinning in 'spin_hits'.
+        @param[in]  window_messages  If non-zero, credit-based flow control: this end lets 
+                                     the other have at most this many messages sent and not 
+                                     yet received, and returns the credit as it receives 
+                                     them. Both ends must enable it, each with its window.
+        @param[in]  window_bytes     Same in bytes. A message is sent while there is any 
+                                     credit left, so up to one message more can be in flight.
+        @param[in]  credit_hook      Function called as credit_hook(pipe) when a message
+                                     cannot be sent for lack of credit, before waiting. It 
+                                     can raise (e.g. BlockingIOError) to drop the message 
+                                     instead. Waits are counted in 'credit_exhausted' and 
+                                     timed in 'credit_wait_ns' (see 'stats'). Messages 
+                                     queued by send_whatever() or send_many() are dropped 
+                                     quietly, and counted in 'messages_dropped'.
         @returns    nothing.
         """
+        if stripes < 1:
+            raise ValueError('The number of stripes must be at least 1.')
         self.pipe_name = pipe_name
         self.lensize = lensize 
         self.header_len = header_len
+        self.pool = BufferPool(pool_size) if pool_size > 0 else None
+        self.dtype_cache = {}
+        if compression is not None and compression not in CODECS:
+            raise ValueError('Compression codec ' + str(compression) + ' is not available.')
+        self.codec = None if compression is None else CODECS[compression]
+        self.metrics = PipeStats(stats_hook) if stats or stats_hook is not None else None
         self.listening = False
         self.connected = False
         self.read_pipe = None
         self.write_pipe = None
 
+        # Extra pairs of FIFOs, (read fd, write fd), and the threads that use them
+        self.stripes = stripes
+        self.pipe_size = Pipe.max_pipe_size() if pipe_size is None and stripes > 1 \
+            else pipe_size or 0
+        self.stripe_pipes = []
+        self.stripe_pool = None
+        self.spin = spin
+
+        # Flow control, credit granted by the other end and credit to be granted to it
+        self.window_messages = window_messages
+        self.window_bytes = window_bytes
+        self.credit_hook = credit_hook
+        self.credit_pipe = None
+        self.grant_pipe = None
+        self.send_credit = [0, 0]
+        self.pending_grant = [0, 0]
+        self.credit_leftover = bytearray()
+        self.credit_lock = threading.RLock()
+
+        # Messages waiting to be written together 
+        self.flush_bytes = flush_bytes
+        self.flush_delay = flush_delay
+        self.send_queue = []
+        self.send_queue_bytes = 0
+        self.send_queue_sizes = []
+        self.flush_timer = None
+        self.send_lock = threading.Lock()
+
+        # Messages written by the writer thread (see send_async)
+        if backpressure not in ('block', 'drop_oldest', 'raise'):
+            raise ValueError('Unknown backpressure policy ' + str(backpressure) + '.')
+        self.async_queue_size = async_queue_size
+        self.backpressure = backpressure
+        self.async_queue = collections.deque()
+        self.async_cond = threading.Condition()
+        self.async_writing = False
+        self.writer = None
+        self.writer_stop = False
+
+        # Messages received by the reader thread (see start_prefetch)
+        self.prefetched = None
+        self.prefetch_kind = None
+
+        # Data read from the pipe that has not been decoded yet (see recv_many)
+        self.read_ahead = bytearray()
+        self.read_ahead_pos = 0
+
         # Register the method cleanup so that it is called on destruction
         atexit.register(self.cleanup)
 
     @staticmethod
     def mkpipe(name):
-        if os.path.exists(name):
-            if not stat.S_ISFIFO(os.stat(name).st_mode):
-                raise ValueError('Path ' + name + ' exists, but it is not a PIPE.')
-        else:
+        # Both ends create the pipes, so the other end may create it at the same time
+        try:
             os.mkfifo(name)
+        except FileExistsError:
+            pass
+        if not stat.S_ISFIFO(os.stat(name).st_mode):
+            raise ValueError('Path ' + name + ' exists, but it is not a PIPE.')
 
 
-    def listen(self):
+    @staticmethod
+    def max_pipe_size():
         """
-        @brief Blocks until a client is connected.
+        @returns the maximum capacity of a pipe that unprivileged users can set.
+        """
+        try:
+            with open('/proc/sys/fs/pipe-max-size') as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 1024 * 1024
+
+
+    def set_pipe_size(self, fd):
+        """
+        @brief Raises the capacity of a FIFO to 'pipe_size' bytes, if the system permits it.
+        """
+        if self.pipe_size > 0:
+            try:
+                fcntl.fcntl(fd, Pipe.F_SETPIPE_SZ, self.pipe_size)
+            except OSError:
+                pass
+
+
+    def open_stripes(self):
+        """
+        @brief Opens the extra pairs of FIFOs (see the 'stripes' option) after the main one.
+               Both ends open them in the same order as the main pair.
+        """
+        for fd in (self.read_pipe, self.write_pipe):
+            self.set_pipe_size(fd)
+        for i in range(1, self.stripes):
+            read_name = self.read_pipe_name + '_' + str(i)
+            write_name = self.write_pipe_name + '_' + str(i)
+            Pipe.mkpipe(write_name)
+            Pipe.mkpipe(read_name)
+            if self.listening:
+                read_pipe = os.open(read_name, os.O_RDONLY)
+                write_pipe = os.open(write_name, os.O_WRONLY)
+            else:
+                write_pipe = os.open(write_name, os.O_WRONLY)
+                read_pipe = os.open(read_name, os.O_RDONLY)
+            self.set_pipe_size(read_pipe)
+            self.set_pipe_size(write_pipe)
+            self.stripe_pipes.append((read_pipe, write_pipe))
+        if self.stripes > 1:
+            self.stripe_pool = concurrent.futures.ThreadPoolExecutor(self.stripes - 1)
+
+
+    def open_credit(self):
+        """
+        @brief Opens the pair of FIFOs of the flow control, if enabled, and exchanges the 
+               initial windows with the other end. Each end writes its grants to the FIFO 
+               named after its input FIFO, and reads those of the other end from the one 
+               named after its output FIFO.
+        """
+        if not self.window_messages and not self.window_bytes:
+            return
+        grant_name = self.read_pipe_name + '_credit'
+        credit_name = self.write_pipe_name + '_credit'
+        Pipe.mkpipe(grant_name)
+        Pipe.mkpipe(credit_name)
+        if self.listening:
+            self.grant_pipe = os.open(grant_name, os.O_WRONLY)
+            self.credit_pipe = os.open(credit_name, os.O_RDONLY)
+        else:
+            self.credit_pipe = os.open(credit_name, os.O_RDONLY)
+            self.grant_pipe = os.open(grant_name, os.O_WRONLY)
+        self.credit_poll = select.poll()
+        self.credit_poll.register(self.credit_pipe, select.POLLIN)
+        os.write(self.grant_pipe, Pipe.GRANT.pack(self.window_messages or Pipe.UNLIMITED, 
+            self.window_bytes or Pipe.UNLIMITED))
+
+        # Wait for the initial window of the other end, so the first messages do not find 
+        # the credit exhausted
+        while self.send_credit[0] <= 0:
+            self.read_credit(-1)
+
+
+    def read_credit(self, timeout_ms):
+        """
+        @brief      Adds the grants written by the other end to the credit available.
+        @param[in]  timeout_ms  Milliseconds to wait for a grant, -1 waits forever.
+        @returns    nothing.
+        """
+        if not self.credit_poll.poll(timeout_ms):
+            return
+        data = os.read(self.credit_pipe, 4096)
+        if not data:
+            raise IOError('The other end closed the pipe.')
+        self.credit_leftover += data
+        complete = len(self.credit_leftover) - len(self.credit_leftover) % Pipe.GRANT.size
+        for messages, nbytes in Pipe.GRANT.iter_unpack(self.credit_leftover[:complete]):
+            self.send_credit[0] += messages
+            self.send_credit[1] += nbytes
+        del self.credit_leftover[:complete]
+
+
+    def has_credit(self):
+        """
+        @returns True if a message can be sent without waiting for credit.
+        """
+        with self.credit_lock:
+            self.read_credit(0)
+            return self.send_credit[0] > 0 and self.send_credit[1] > 0
+
+
+    def take_credit(self, nbytes, messages=1, hook=True):
+        """
+        @brief      Waits until there is credit to send, and takes what the messages use.
+                    Only called if flow control is enabled.
+        @param[in]  nbytes    Size of the messages.
+        @param[in]  messages  Number of messages.
+        @param[in]  hook      False if credit_hook has been called already.
+        @returns    nothing.
+        """
+        with self.credit_lock:
+            self.read_credit(0)
+            if self.send_credit[0] <= 0 or self.send_credit[1] <= 0:
+                if self.metrics is not None:
+                    self.metrics.count('credit_exhausted')
+                if hook and self.credit_hook is not None:
+                    self.credit_hook(self)
+                tic = time.perf_counter_ns()
+                while self.send_credit[0] <= 0 or self.send_credit[1] <= 0:
+                    self.read_credit(-1)
+                if self.metrics is not None:
+                    self.metrics.time('credit_wait_ns', time.perf_counter_ns() - tic)
+            self.send_credit[0] -= messages
+            self.send_credit[1] -= nbytes
+
+
+    def grant(self, nbytes, messages=1):
+        """
+        @brief Returns the credit of received messages to the other end, in batches of 
+               half the window.
+        """
+        self.pending_grant[0] += messages
+        self.pending_grant[1] += nbytes
+        if 0 < self.window_messages <= 2 * self.pending_grant[0] \
+                or 0 < self.window_bytes <= 2 * self.pending_grant[1]:
+            os.write(self.grant_pipe, Pipe.GRANT.pack(*self.pending_grant))
+            self.pending_grant = [0, 0]
+
+
+    def credit(self):
+        """
+        @brief      Credit granted by the other end that has not been used yet, e.g. to 
+                    drop messages early instead of waiting for the other end.
+        @returns    a tuple (messages, bytes), None if flow control is not enabled.
+        """
+        if self.credit_pipe is None:
+            return None
+        with self.credit_lock:
+            self.read_credit(0)
+            return tuple(self.send_credit)
+
+
+    @staticmethod
+    def message_bytes(buffers):
+        """
+        @returns the size in bytes of an encoded message.
+        """
+        return sum(memoryview(b.buf if isinstance(b, Striped) else b).nbytes for b in buffers)
+
+
+    def listen(self, timeout=None):
+        """
+        @brief      Blocks until a client is connected.
+        @param[in]  timeout  Maximum number of seconds to wait for the client to open the 
+                             main pair of FIFOs, None waits forever. Raises TimeoutError
+                             when it expires.
+        @returns    nothing.
         """
-        self.listening = True
-        
         # Compile the pipe paths
         self.write_pipe_name = os.path.join(tempfile.gettempdir(), '.' + self.pipe_name + '_client')
         self.read_pipe_name = os.path.join(tempfile.gettempdir(), '.' + self.pipe_name + '_server')
@@ -98,8 +853,29 @@ class Pipe(BaseIPC):
         Pipe.mkpipe(self.read_pipe_name)
 
         # Open pipes
-        self.read_pipe = os.open(self.read_pipe_name, os.O_RDONLY)
-        self.write_pipe = os.open(self.write_pipe_name, os.O_WRONLY)
+        if timeout is None:
+            self.read_pipe = os.open(self.read_pipe_name, os.O_RDONLY)
+            self.write_pipe = os.open(self.write_pipe_name, os.O_WRONLY)
+        else:
+            # Opening the output FIFO without blocking fails until the client opens it 
+            # for reading, which it does after opening our input FIFO
+            self.read_pipe = os.open(self.read_pipe_name, os.O_RDONLY | os.O_NONBLOCK)
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    self.write_pipe = os.open(self.write_pipe_name, os.O_WRONLY | os.O_NONBLOCK)
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        os.close(self.read_pipe)
+                        raise TimeoutError('No client opened the pipe ' + self.pipe_name + '.')
+                    time.sleep(0.001)
+            os.set_blocking(self.read_pipe, True)
+            os.set_blocking(self.write_pipe, True)
+        self.listening = True
+
+        self.open_stripes()
+        self.open_credit()
 
         # Create polling object for the reading pipe
         self.poll = select.poll()
@@ -124,119 +900,2777 @@ class Pipe(BaseIPC):
         self.write_pipe = os.open(self.write_pipe_name, os.O_WRONLY)
         self.read_pipe = os.open(self.read_pipe_name, os.O_RDONLY)
 
+        self.open_stripes()
+        self.open_credit()
+
         # Create polling object for the reading pipe
         self.poll = select.poll()
         self.poll.register(self.read_pipe, select.POLLIN) 
 
 
+    def stop_writer(self):
+        """
+        @brief Stops the flush timer, and the writer thread once it has written the 
+               messages it was given, and writes the messages still queued. If the writer 
+               thread is still blocked after close_timeout seconds (the other end is not 
+               reading), the messages it has not started are cancelled.
+        """
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+        stuck = False
+        if self.writer is not None:
+            with self.async_cond:
+                self.writer_stop = True
+                self.async_cond.notify_all()
+            self.writer.join(self.close_timeout)
+            if self.writer.is_alive():
+                stuck = True
+                with self.async_cond:
+                    while self.async_queue:
+                        self.async_queue.popleft()[1].cancel()
+                    self.async_cond.notify_all()
+            self.writer = None
+
+        # Messages queued by send_whatever() are written before the pipe is closed, unless
+        # the writer thread holds the pipe
+        if self.listening or self.connected:
+            try:
+                self.write_queued(blocking=not stuck)
+            except OSError:
+                # The other end is gone
+                pass
+
+
     def cleanup(self):
+        self.stop_writer()
         if self.listening or self.connected:
             os.close(self.read_pipe)
             os.close(self.write_pipe)
+            for read_pipe, write_pipe in self.stripe_pipes:
+                os.close(read_pipe)
+                os.close(write_pipe)
+            self.stripe_pipes = []
+            if self.credit_pipe is not None:
+                os.close(self.credit_pipe)
+                os.close(self.grant_pipe)
+                self.credit_pipe = None
+                self.grant_pipe = None
+            if self.stripe_pool is not None:
+                self.stripe_pool.shutdown()
+                self.stripe_pool = None
+            self.listening = False
+            self.connected = False
 
 
-    def recv_whatever(self, blocking=True):
-        """ 
-        @brief    This methods uses pickle, so whatever object serialisable by pickle is good.
-        @details  This is a blocking operation. 
-        @returns  whhatever object sent from the other end or None if there is 
-                  nothing available to be read and we are in non-blocking mode.
+    def write_buffers(self, buffers, fd=None):
         """
-        if not blocking and (self.read_pipe, select.POLLIN) not in self.poll.poll(1):
-            return None
+        @brief      Writes a list of buffers to the output pipe without joining them.
+        @details    This is a vectored write (writev), so the header and the body of a 
+                    message go out in the same system call and the body is written straight
+                    from the memory of the caller. It blocks until all the data is written.
+        @param[in]  buffers  List of objects supporting the buffer protocol. If the last 
+                             one is Striped, it is split among the stripes.
+        @param[in]  fd       Output FIFO, the main one by default.
+        @returns    nothing.
+        """
+        if buffers and isinstance(buffers[-1], Striped):
+            return self.write_striped(buffers[:-1], buffers[-1].buf)
+        if fd is None:
+            fd = self.write_pipe
+        views = [memoryview(b) for b in buffers]
+        views = [v.cast('B') for v in views if v.nbytes > 0]
+        while views:
+            # Linux does not accept more than IOV_MAX (1024) buffers per call
+            if self.metrics is None:
+                written = os.writev(fd, views[:1024])
+            else:
+                tic = time.perf_counter_ns()
+                written = os.writev(fd, views[:1024])
+                self.metrics.io('write', sum(v.nbytes for v in views[:1024]), written, 
+                    time.perf_counter_ns() - tic)
 
-        # Read header containing the size of the message
-        raw_length = os.read(self.read_pipe, self.lensize)
-        length = struct.unpack(BaseIPC.lensize_dict[self.lensize], raw_length)[0]
+            # Drop what has been written already
+            while views and written >= views[0].nbytes:
+                written -= views[0].nbytes
+                views.pop(0)
+            if written:
+                views[0] = views[0][written:]
 
-        # Read the actual message
-        body = os.read(self.read_pipe, length)
 
-        # Quick integrity check
-        if length != len(body):
-            raise IOError('Message received has a different size than expected.')
-        
-        return pickle.loads(body)
+    def read_into(self, buf, fd=None):
+        """
+        @brief      Fills the buffer with data from the input pipe.
+        @details    The pipe returns at most its capacity on each read, so we keep reading
+                    until the buffer is full. It blocks until all the data has arrived.
+        @param[in]  buf  Writable object supporting the buffer protocol.
+        @param[in]  fd   Input FIFO of a stripe, the main one by default.
+        @returns    nothing.
+        """
+        if fd is None:
+            fd = self.read_pipe
+            view = self.take_read_ahead(buf)
+        else:
+            view = memoryview(buf).cast('B')
+        while view.nbytes > 0:
+            if self.metrics is None:
+                nbytes = os.readv(fd, [view])
+            else:
+                tic = time.perf_counter_ns()
+                nbytes = os.readv(fd, [view])
+                self.metrics.io('read', view.nbytes, nbytes, time.perf_counter_ns() - tic)
+            if nbytes == 0:
+                raise IOError('The other end closed the pipe in the middle of a message.')
+            view = view[nbytes:]
 
 
-    def send_whatever(self, data):
-        """ 
-        @brief    This methods uses pickle, so whatever object serialisable by pickle is good.
-        @details  This is a blocking operation. It blocks when the pipe is full.
-                  A pipe has a limited capacity (typically 16 pages). This method will block 
-                  until data has been read and there is space again.
-        @returns  nothing.
+    def stripe_bounds(self, length):
+        """
+        @returns the offsets where the slices of a body of 'length' bytes start and end.
         """
-        body = pickle.dumps(data)
-        length = struct.pack(BaseIPC.lensize_dict[self.lensize], len(body))
-        os.write(self.write_pipe, length)
-        os.write(self.write_pipe, body)
+        return [length * i // self.stripes for i in range(self.stripes + 1)]
 
 
-    def recv_array(self, blocking=True):
-        """ 
-        @brief      Pickle is quite slow for large numpy arrays, so we have this dedicated method.
-        @details    This is a blocking operation (if there is no data available).
-        @returns    a numpy.ndarray. If blocking is False and there is nothing to be read, it
-                    quickly returns None.
+    def striped(self, buf):
         """
-        if not blocking and (self.read_pipe, select.POLLIN) not in self.poll.poll(1):
-            return None
+        @returns the uncompressed body of an array, marked as Striped if it is large enough
+                 to be split among the stripes.
+        """
+        if self.stripes > 1 and memoryview(buf).nbytes >= self.stripe_threshold:
+            return Striped(buf)
+        return buf
 
-        # Read length 
-        raw_length = os.read(self.read_pipe, self.lensize)
-        length = struct.unpack(BaseIPC.lensize_dict[self.lensize], raw_length)[0]
-        
-        # Read header 
-        header = os.read(self.read_pipe, self.header_len) 
-        header_len = struct.unpack(BaseIPC.lensize_dict[self.lensize], header[:self.lensize])[0]
-        header_info = eval(header[self.lensize:self.lensize + header_len].decode('ascii'))
 
-        # Read body
-        body = os.read(self.read_pipe, length - self.header_len)
-        data = np.frombuffer(body, dtype=header_info['dtype']).reshape(header_info['shape'])
+    def write_striped(self, buffers, body):
+        """
+        @brief      Writes the buffers and the first slice of the body to the main FIFO, 
+                    while the pool of threads writes the other slices to their stripes.
+                    The threads run in parallel as os.writev() releases the GIL.
+        """
+        body = memoryview(body).cast('B')
+        bounds = self.stripe_bounds(body.nbytes)
+        futures = [self.stripe_pool.submit(self.write_buffers, [body[bounds[i]:bounds[i + 1]]],
+            self.stripe_pipes[i - 1][1]) for i in range(1, self.stripes)]
+        try:
+            self.write_buffers(buffers + [body[:bounds[1]]])
+        finally:
+            for future in futures:
+                future.result()
 
-        # Quick integrity check 
-        if length - len(header) != len(body):
-            raise IOError('The amount of data read is different than expected.')
 
-        return data
+    def read_striped(self, buf):
+        """
+        @brief Fills the buffer with the slices of a body written by write_striped(), each 
+               read straight into its region of the buffer.
+        """
+        view = memoryview(buf).cast('B')
+        bounds = self.stripe_bounds(view.nbytes)
+        futures = [self.stripe_pool.submit(self.read_into, view[bounds[i]:bounds[i + 1]],
+            self.stripe_pipes[i - 1][0]) for i in range(1, self.stripes)]
+        try:
+            self.read_into(view[:bounds[1]])
+        finally:
+            for future in futures:
+                future.result()
 
 
-    def send_array(self, data):
-        """ 
-        @brief      Pickle is quite slow for large numpy arrays, so we have this dedicated method.
+    def take_read_ahead(self, buf):
+        """
+        @brief      Fills the buffer with the data read ahead by recv_many(), if any.
+        @param[in]  buf  Writable object supporting the buffer protocol.
+        @returns    a byte memoryview of the part of the buffer that is still empty.
+        """
+        view = memoryview(buf)
+        if view.nbytes > 0:
+            view = view.cast('B')
+        available = len(self.read_ahead) - self.read_ahead_pos
+        if available > 0 and view.nbytes > 0:
+            nbytes = min(available, view.nbytes)
+            view[:nbytes] = memoryview(self.read_ahead)[self.read_ahead_pos:self.read_ahead_pos + nbytes]
+            self.read_ahead_pos += nbytes
+            if self.read_ahead_pos == len(self.read_ahead):
+                self.read_ahead = bytearray()
+                self.read_ahead_pos = 0
+            view = view[nbytes:]
+        return view
 
-        @details    This is a blocking operation. It blocks when the pipe is full.
-                    A pipe has a limited capacity (typically 16 pages). This method will block 
-                    until data has been read and there is space again.
 
-                    Message structure: [ length | header | body ]
+    def readable(self, timeout_ms):
+        """
+        @param[in]  timeout_ms  Milliseconds to wait for data, -1 waits forever.
+        @returns    True if there is data to be read.
+        """
+        if self.read_ahead_pos < len(self.read_ahead):
+            return True
 
-                    length: self.lensize bytes
-                    header: 128 bytes
-                    body  : whatever 'length' says minus the 64 of the header
-    
-        @param[in]  data  Numpy.ndarray.
-        @returns    nothing.
+        # POLLHUP also counts, the pipe may still have data after the other end closed it
+        return len(self.poll.poll(timeout_ms)) > 0
+
+
+    def wait_readable(self, timeout=None):
         """
-        # Generate the bytes of the array
-        body = data.tobytes()
-        
-        # Generate the bytes of the length
-        length = struct.pack(BaseIPC.lensize_dict[self.lensize], len(body) + self.header_len)
-
-        # Generate the bytes of the header
-        header_info = str({'shape': data.shape, 'dtype': data.dtype.name}).encode('ascii')
-        header = bytearray(self.header_len)
-        header[:self.lensize] = struct.pack(BaseIPC.lensize_dict[self.lensize], len(header_info))
-        header[self.lensize:self.lensize + len(header_info)] = header_info
-
-        # Send length, header, and body 
-        os.write(self.write_pipe, length)
-        os.write(self.write_pipe, header)
-        os.write(self.write_pipe, body)
-        
+        @brief      Waits for the next message to start arriving, polling without sleeping 
+                    for the first 'spin' seconds.
+        @param[in]  timeout  Maximum number of seconds to wait, None waits forever.
+        @returns    True if there is data to be read.
+        """
+        if not self.spin and self.metrics is None:
+            return timeout is None or self.readable(math.ceil(timeout * 1000))
+
+        tic = time.perf_counter_ns()
+        ready = self.readable(0)
+        if self.spin:
+            deadline = tic + int(1e9 * (self.spin if timeout is None else min(self.spin, timeout)))
+            while not ready and time.perf_counter_ns() < deadline:
+                ready = self.readable(0)
+            if self.metrics is not None:
+                self.metrics.count('spin_hits' if ready else 'spin_misses')
+        if not ready and timeout is None:
+            ready = self.readable(-1)
+        elif not ready and timeout > 0:
+            remaining = timeout - (time.perf_counter_ns() - tic) / 1e9
+            ready = self.readable(max(0, math.ceil(remaining * 1000)))
+        if self.metrics is not None:
+            self.metrics.time('wait_ns', time.perf_counter_ns() - tic)
+        return ready
+
+
+    def run_decoder(self, decoder, message=True):
+        """
+        @brief      Reads a message from the input pipe using one of the decoders below.
+        @details    Decoders are generators that yield the buffers that have to be filled 
+                    with the next bytes of the message, and return the decoded message. This
+                    way the same decoder is used for blocking and asynchronous reads.
+        @param[in]  decoder  Generator such as decode_whatever() or decode_array().
+        @param[in]  message  False if the bytes read are not a whole message, so they are 
+                             not granted back to the other end by the flow control.
+        @returns    the decoded message.
+        """
+        if self.grant_pipe is None or not message:
+            try:
+                buf = next(decoder)
+                while True:
+                    if isinstance(buf, Striped):
+                        self.read_striped(buf.buf)
+                    else:
+                        self.read_into(buf)
+                    buf = next(decoder)
+            except StopIteration as stop:
+                return stop.value
+
+        # Count the bytes of the message, even if the decoder raises at the end
+        nbytes = 0
+        try:
+            buf = next(decoder)
+            while True:
+                if isinstance(buf, Striped):
+                    self.read_striped(buf.buf)
+                else:
+                    self.read_into(buf)
+                nbytes += Pipe.message_bytes([buf])
+                buf = next(decoder)
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            self.grant(nbytes)
+
+
+    def decode_discard(self, length, body=False):
+        """
+        @brief Decoder that throws away the next 'length' bytes of the input pipe. If they 
+               are the uncompressed 'body' of an array, they may come from the stripes.
+        """
+        if body and self.stripes > 1 and length >= self.stripe_threshold:
+            yield Striped(np.empty(length, dtype=np.uint8))
+            return
+        scratch = bytearray(min(length, 1 << 20))
+        while length > 0:
+            nbytes = min(length, len(scratch))
+            yield memoryview(scratch)[:nbytes]
+            length -= nbytes
+
+
+    def compress(self, buf):
+        """
+        @brief      Compresses a buffer with the codec of the pipe if it is worth it.
+        @details    The first compression_sample bytes are compressed first, so that 
+                    incompressible data (e.g. float noise) only costs a small compression.
+        @param[in]  buf  Contiguous buffer of bytes, e.g. a numpy array of uint8.
+        @returns    a tuple (codec id, bytes), with codec id 0 and 'buf' itself if it is
+                    not compressed.
+        """
+        nbytes = memoryview(buf).nbytes
+        if self.codec is None or nbytes < self.compression_threshold:
+            return 0, buf
+        sample = buf[:self.compression_sample]
+        if len(self.codec.compress(sample)) > self.compression_ratio * len(sample):
+            return 0, buf
+        compressed = self.codec.compress(buf)
+        if len(compressed) >= nbytes:
+            return 0, buf
+        return self.codec.codec_id, compressed
+
+
+    def decompress_into(self, codec_id, src, dst):
+        """
+        @brief Decompresses 'src' straight into the buffer 'dst'.
+        """
+        codec = CODECS.get(codec_id)
+        if codec is None:
+            raise IOError('Unknown compression codec ' + str(codec_id) + '.')
+        codec.decompress_into(src, dst)
+
+
+    def decode_whatever(self):
+        """
+        @brief Decoder of the messages written by encode_whatever().
+        """
+        # Read header containing the size of the pickle and the number of buffers
+        raw = bytearray(self.lensize + 4)
+        yield raw
+        length = struct.unpack_from(BaseIPC.lensize_dict[self.lensize], raw)[0]
+        nbuffers = struct.unpack_from('>I', raw, self.lensize)[0]
+        if nbuffers & Pipe.SERIALIZED:
+            return (yield from self.decode_serialized(length))
+        codec_id, nbuffers = nbuffers >> 24, nbuffers & 0xffffff
+        nlengths = 2 * nbuffers if codec_id else nbuffers
+
+        # Read the sizes of the buffers and the pickle
+        raw = bytearray(nlengths * self.lensize + length)
+        yield raw
+        lengths = struct.unpack_from('>' + nlengths * BaseIPC.lensize_dict[self.lensize][1:], raw)
+        body = memoryview(raw)[nlengths * self.lensize:]
+
+        # Read the out-of-band buffers, numpy arrays of bytes are aligned for any dtype
+        buffers = []
+        for i in range(nbuffers):
+            wire_len, buf_len = lengths[2 * i:2 * i + 2] if codec_id else (lengths[i], lengths[i])
+            buf = np.empty(buf_len, dtype=np.uint8)
+            if wire_len == buf_len:
+                yield buf
+            else:
+                compressed = bytearray(wire_len)
+                yield compressed
+                self.decompress_into(codec_id, compressed, buf)
+            buffers.append(buf)
+
+        if self.metrics is None:
+            return pickle.loads(body, buffers=buffers)
+        tic = time.perf_counter_ns()
+        data = pickle.loads(body, buffers=buffers)
+        self.metrics.time('unpickle_ns', time.perf_counter_ns() - tic)
+        self.metrics.count('messages_received')
+        return data
+
+
+    def decode_serialized(self, length):
+        """
+        @brief Decoder of the rest of a message written by encode_serialized().
+        """
+        raw = bytearray(length)
+        yield raw
+        tag = struct.unpack_from('>H', raw)[0]
+        if tag not in SERIALIZERS:
+            raise ValueError('Received a message of unknown serializer tag ' + str(tag) + '.')
+        tic = None if self.metrics is None else time.perf_counter_ns()
+        data = SERIALIZERS[tag].decode(memoryview(raw)[2:])
+        if tic is not None:
+            self.metrics.time('unpickle_ns', time.perf_counter_ns() - tic)
+            self.metrics.count('messages_received')
+        return data
+
+
+    def encode_serialized(self, data):
+        """
+        @brief      Encodes an object with the serializer registered for its type, if any.
+
+        @details    Message structure: [ length | flag | tag | body ]
+
+                    length: self.lensize bytes with the size of tag and body
+                    flag  : 4 bytes, Pipe.SERIALIZED
+                    tag   : 2 bytes, the tag of the serializer
+                    body  : the bytes returned by the serializer
+
+        @returns    the list of buffers that make up the message, or None if the object has 
+                    to be pickled.
+        """
+        serializer = SERIALIZERS.get(type(data))
+        if serializer is None:
+            return None
+        tic = None if self.metrics is None else time.perf_counter_ns()
+        try:
+            body = serializer.encode(data)
+        except (TypeError, ValueError, OverflowError, struct.error):
+            return None
+        if tic is not None:
+            self.metrics.time('pickle_ns', time.perf_counter_ns() - tic)
+            self.metrics.count('messages_sent')
+        header = struct.pack(BaseIPC.lensize_dict[self.lensize], len(body) + 2) \
+            + struct.pack('>IH', Pipe.SERIALIZED, serializer.tag)
+        return [header, body]
+
+
+    def encode_whatever(self, data):
+        """
+        @brief      Serialises an object with pickle protocol 5. The buffers of large objects
+                    such as numpy arrays are not copied into the pickle, they are written 
+                    from their own memory after it. Objects of a type with a registered 
+                    Serializer are encoded with it instead (see encode_serialized).
+        
+        @details    Message structure: [ length | nbuffers | buffer lengths | pickle | buffers ]
+
+                    length        : self.lensize bytes with the size of the pickle
+                    nbuffers      : 4 bytes, the codec id in the highest byte
+                    buffer lengths: self.lensize bytes per buffer, or two (compressed and
+                                    decompressed size) if there is a codec id. Buffers 
+                                    with both sizes equal are not compressed.
+
+        @returns    the list of buffers that make up the message.
+        """
+        if SERIALIZERS:
+            buffers = self.encode_serialized(data)
+            if buffers is not None:
+                return buffers
+
+        buffers = []
+        def buffer_callback(buf):
+            # Returning False sends the buffer out-of-band
+            if buf.raw().nbytes < self.oob_threshold:
+                return True
+            buffers.append(buf.raw())
+            return False
+        if self.metrics is None:
+            body = pickle.dumps(data, protocol=5, buffer_callback=buffer_callback)
+        else:
+            tic = time.perf_counter_ns()
+            body = pickle.dumps(data, protocol=5, buffer_callback=buffer_callback)
+            self.metrics.time('pickle_ns', time.perf_counter_ns() - tic)
+            self.metrics.count('messages_sent')
+
+        # Compress the out-of-band buffers
+        lengths = [b.nbytes for b in buffers]
+        codec_id = 0
+        if self.codec is not None:
+            compressed = [self.compress(b) for b in buffers]
+            if any(c[0] for c in compressed):
+                codec_id = self.codec.codec_id
+                lengths = [n for (_, c), b in zip(compressed, buffers) for n in (len(c), b.nbytes)]
+                buffers = [c for _, c in compressed]
+
+        lensize_format = BaseIPC.lensize_dict[self.lensize]
+        header = struct.pack(lensize_format, len(body)) \
+            + struct.pack('>I', codec_id << 24 | len(buffers)) \
+            + struct.pack('>' + len(lengths) * lensize_format[1:], *lengths)
+        return [header, body] + buffers
+
+
+    def encode_dtype(self, dtype):
+        """
+        @returns a tuple (flags, descriptor) with the bytes that describe the dtype. Simple 
+                 dtypes are described by their string, e.g. '<f4', which keeps the byte 
+                 order. Structured dtypes are described by their numpy descr literal.
+        """
+        if dtype.hasobject:
+            raise ValueError('Arrays of Python objects cannot be sent with send_array(), '
+                + 'use send_whatever() instead.')
+        if dtype.fields is None and dtype.subdtype is None:
+            return 0, dtype.str.encode('ascii')
+        return Pipe.STRUCTURED, repr(np.lib.format.dtype_to_descr(dtype)).encode('ascii')
+
+
+    def decode_dtype(self, flags, descr):
+        """
+        @returns the dtype described by encode_dtype(), parsed only once per descriptor.
+        """
+        key = (flags & Pipe.STRUCTURED, descr)
+        dtype = self.dtype_cache.get(key)
+        if dtype is None:
+            if flags & Pipe.STRUCTURED:
+                dtype = np.lib.format.descr_to_dtype(ast.literal_eval(descr.decode('ascii')))
+            else:
+                dtype = np.dtype(descr.decode('ascii'))
+            self.dtype_cache[key] = dtype
+        return dtype
+
+
+    def decode_array_header(self):
+        """
+        @brief      Decoder of the length and header written by encode_array().
+        @returns    a tuple (body length, shape, dtype, fortran, codec id).
+        """
+        # Read length and header, which fit in a single read unless they are large
+        raw = bytearray(self.lensize + self.header_len)
+        yield raw
+        length = struct.unpack_from(BaseIPC.lensize_dict[self.lensize], raw)[0]
+        version, flags, ndim, descr_len = Pipe.ARRAY_HEADER.unpack_from(raw, self.lensize)
+        if version != Pipe.ARRAY_HEADER_VERSION:
+            raise IOError('Unsupported array header version ' + str(version) + '.')
+        header_size = Pipe.ARRAY_HEADER.size + 8 * ndim + descr_len
+        if header_size > self.header_len:
+            extra = bytearray(header_size - self.header_len)
+            yield extra
+            raw += extra
+        
+        # Parse shape and dtype
+        tic = None if self.metrics is None else time.perf_counter_ns()
+        offset = self.lensize + Pipe.ARRAY_HEADER.size
+        shape = struct.unpack_from('>%dQ' % ndim, raw, offset)
+        descr = bytes(raw[offset + 8 * ndim:offset + 8 * ndim + descr_len])
+        dtype = self.decode_dtype(flags, descr)
+
+        body_len = length - max(header_size, self.header_len)
+        if tic is not None:
+            self.metrics.time('header_decode_ns', time.perf_counter_ns() - tic)
+            self.metrics.count('messages_received')
+        return body_len, shape, dtype, bool(flags & Pipe.FORTRAN), flags >> Pipe.CODEC_SHIFT
+
+
+    def decode_array(self, out=None):
+        """
+        @brief      Decoder of the messages written by encode_array().
+        @details    The body is read directly into the memory of the returned array. The 
+                    array is 'out' if given, otherwise it is taken from the pool of recycled 
+                    arrays or newly allocated.
+        """
+        body_len, shape, dtype, fortran, codec_id = yield from self.decode_array_header()
+
+        # Check that the header matches the size of the body, the body is discarded
+        # otherwise so that the next message can still be read
+        if not codec_id and body_len != int(np.prod(shape)) * dtype.itemsize:
+            yield from self.decode_discard(body_len, body=True)
+            raise IOError('The size of the array is different than expected.')
+
+        # Get an array to hold the body, if 'out' is not suitable the body is discarded.
+        # Fortran-ordered arrays are received as the transpose of a C-ordered array.
+        copy_to_out = False
+        try:
+            if not fortran:
+                data = self.get_array(shape, dtype, out)
+            elif out is None or out.flags.f_contiguous:
+                data = self.get_array(shape[::-1], dtype, None if out is None else out.T).T
+            else:
+                # The body has to be reordered to fit a C-ordered out
+                copy_to_out = True
+                self.get_array(shape, dtype, out)
+                data = np.empty(shape[::-1], dtype=dtype).T
+        except ValueError:
+            yield from self.decode_discard(body_len, body=not codec_id)
+            raise
+
+        # Read body, compressed bodies are decompressed straight into the array
+        dst = (data.T if fortran else data).reshape(-1).view(np.uint8)
+        if not codec_id:
+            yield self.striped(dst)
+        else:
+            compressed = bytearray(body_len)
+            yield compressed
+            self.decompress_into(codec_id, compressed, dst)
+
+        if copy_to_out:
+            np.copyto(out, data)
+            return out
+        return data if out is None else out
+
+
+    def encode_array(self, data):
+        """ 
+        @brief      Message structure: [ length | header | body ]
+
+                    length: self.lensize bytes with the size of header and body
+                    header: [ version | flags | ndim | descr_len | shape | descr ], 1, 1, 
+                            2, 4 and 8 * ndim bytes followed by the dtype descriptor (see 
+                            encode_dtype). It is padded to self.header_len bytes. The 
+                            highest 4 bits of the flags are the codec id of the body.
+                    body  : the bytes of the array, compressed if there is a codec id.
+                            Large uncompressed bodies are split among the stripes.
+
+                    The body is the memory of the array, no copies are made unless the 
+                    array is neither C-contiguous nor Fortran-contiguous. Fortran-ordered 
+                    arrays are sent in Fortran order.
+    
+        @param[in]  data  Numpy.ndarray.
+        @returns    the list of buffers that make up the message.
+        """
+        flags, descr = self.encode_dtype(data.dtype)
+
+        # Get the bytes of the array without copying them
+        if data.flags.f_contiguous and not data.flags.c_contiguous:
+            flags |= Pipe.FORTRAN
+            body = data.T.reshape(-1).view(np.uint8)
+        else:
+            body = np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+
+        codec_id, body = self.compress(body)
+        flags |= codec_id << Pipe.CODEC_SHIFT
+        header = self.encode_array_header(data.shape, flags, descr, len(body))
+        return [header, body if codec_id else self.striped(body)]
+
+
+    def encode_array_header(self, shape, flags, descr, body_len):
+        """
+        @returns the bytes of the length and header of an array message (see encode_array).
+        """
+        tic = None if self.metrics is None else time.perf_counter_ns()
+        header = Pipe.ARRAY_HEADER.pack(Pipe.ARRAY_HEADER_VERSION, flags, len(shape), len(descr)) \
+            + struct.pack('>%dQ' % len(shape), *shape) + descr
+        if len(header) < self.header_len:
+            header += bytes(self.header_len - len(header))
+        length = struct.pack(BaseIPC.lensize_dict[self.lensize], len(header) + body_len)
+        if tic is not None:
+            self.metrics.time('header_encode_ns', time.perf_counter_ns() - tic)
+            self.metrics.count('messages_sent')
+        return length + header
+
+
+    def recv_whatever(self, blocking=True, timeout=None):
+        """ 
+        @brief    This methods uses pickle, so whatever object serialisable by pickle is good.
+        @details  This is a blocking operation. The large buffers sent out-of-band (see 
+                  send_whatever) are read directly into the memory that the unpickled 
+                  objects will use.
+        @param[in]  timeout  Maximum number of seconds to wait for the message to start 
+                             arriving, None waits forever. Non-blocking mode is a timeout
+                             of zero.
+        @returns  whhatever object sent from the other end or None if there is 
+                  nothing available to be read and we are in non-blocking mode or the 
+                  timeout expires.
+        """
+        timeout = 0 if not blocking else timeout
+        if self.prefetched is not None:
+            return self.recv_prefetched('whatever', timeout)
+        self.write_queued(blocking=False)
+        if not self.wait_readable(timeout):
+            return None
+        return self.run_decoder(self.decode_whatever())
+
+
+    def send_whatever(self, data):
+        """ 
+        @brief    This methods uses pickle, so whatever object serialisable by pickle is good.
+        @details  This is a blocking operation. It blocks when the pipe is full.
+                  A pipe has a limited capacity (typically 16 pages). This method will block 
+                  until data has been read and there is space again.
+
+                  Pickle protocol 5 is used, so the buffers of large objects such as numpy 
+                  arrays are not copied into the pickle (see encode_whatever).
+        @returns  nothing.
+        """
+        buffers = self.encode_whatever(data)
+        if self.flush_bytes <= 0:
+            if self.writer is not None:
+                self.wait_async()
+            with self.send_lock:
+                if self.credit_pipe is not None:
+                    self.take_credit(Pipe.message_bytes(buffers))
+                self.write_buffers(buffers)
+            return
+
+        # Queue the message, it is written when the queue is large or old enough
+        with self.send_lock:
+            self.send_queue += buffers
+            self.send_queue_bytes += sum(memoryview(b).nbytes for b in buffers)
+            self.send_queue_sizes.append(len(buffers))
+            if self.send_queue_bytes < self.flush_bytes:
+                if self.flush_timer is None:
+                    self.flush_timer = threading.Timer(self.flush_delay, self.flush)
+                    self.flush_timer.daemon = True
+                    self.flush_timer.start()
+                return
+        self.flush()
+
+
+    def flush(self):
+        """
+        @brief Waits until the messages of send_async() and send_array_async() are written,
+               and writes the messages queued by send_whatever() and send_many().
+        """
+        if self.writer is not None:
+            self.wait_async()
+        self.write_queued()
+
+
+    def write_queued(self, blocking=True):
+        """
+        @brief      Writes the messages queued by send_whatever() and send_many().
+        @param[in]  blocking  False when receiving: the messages are written only if no 
+                              other thread is sending (e.g. blocked on a full pipe), the 
+                              flush timer writes them otherwise. A receiving thread must 
+                              not wait for a sender, the other end may be waiting for it.
+        @returns    nothing.
+        """
+        if not self.send_queue:
+            return
+        if not self.send_lock.acquire(blocking):
+            return
+        try:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if self.send_queue:
+                queued, sizes = self.send_queue, self.send_queue_sizes
+                self.send_queue = []
+                self.send_queue_bytes = 0
+                self.send_queue_sizes = []
+                if self.credit_pipe is None:
+                    self.write_buffers(Pipe.coalesce(queued))
+                else:
+                    self.write_credited(queued, sizes)
+        finally:
+            self.send_lock.release()
+
+
+    def write_credited(self, buffers, sizes):
+        """
+        @brief      Writes queued messages taking credit for each one. Those that have 
+                    credit are written together before waiting for more, and those that 
+                    credit_hook rejects are dropped.
+        @param[in]  buffers  Buffers of the messages, one after the other.
+        @param[in]  sizes    Number of buffers of each message.
+        @returns    nothing.
+        """
+        batch = []
+        start = 0
+        for nbuffers in sizes:
+            message = buffers[start:start + nbuffers]
+            start += nbuffers
+            if not self.has_credit():
+                # Let the other end receive what has credit, it grants more as it does
+                if batch:
+                    self.write_buffers(Pipe.coalesce(batch))
+                    batch = []
+                if self.credit_hook is not None:
+                    try:
+                        self.credit_hook(self)
+                    except Exception:
+                        if self.metrics is not None:
+                            self.metrics.count('credit_exhausted')
+                            self.metrics.count('messages_dropped')
+                        continue
+            self.take_credit(Pipe.message_bytes(message), hook=False)
+            batch += message
+        if batch:
+            self.write_buffers(Pipe.coalesce(batch))
+
+
+    @staticmethod
+    def coalesce(buffers, max_size=64 * 1024):
+        """
+        @brief      Joins consecutive small buffers so that many small messages do not need 
+                    one iovec each. Large buffers are left as they are.
+        @param[in]  buffers   List of objects supporting the buffer protocol.
+        @param[in]  max_size  Buffers of at least this size are not copied.
+        @returns    a list of buffers with the same bytes.
+        """
+        coalesced = []
+        small = bytearray()
+        for buf in buffers:
+            if memoryview(buf).nbytes < max_size:
+                small += buf
+                continue
+            if small:
+                coalesced.append(small)
+                small = bytearray()
+            coalesced.append(buf)
+        if small:
+            coalesced.append(small)
+        return coalesced
+
+
+    def send_many(self, iterable):
+        """
+        @brief      Sends many objects with as few writes as possible.
+        @details    The messages are the same as those of send_whatever(), so the other end 
+                    can receive them with recv_whatever() or recv_many().
+        @param[in]  iterable  Objects serialisable by pickle.
+        @returns    nothing.
+        """
+        buffers = []
+        sizes = []
+        for data in iterable:
+            message = self.encode_whatever(data)
+            buffers += message
+            sizes.append(len(message))
+        with self.send_lock:
+            self.send_queue += buffers
+            self.send_queue_bytes += sum(memoryview(b).nbytes for b in buffers)
+            self.send_queue_sizes += sizes
+        self.flush()
+
+
+    def send_async(self, data):
+        """
+        @brief      Same as send_whatever(), but the message is written by a background 
+                    thread so that the caller does not wait for the other end.
+        @details    The object is pickled before returning, but the memory of its large 
+                    buffers (e.g. numpy arrays) is written as it is when the message goes 
+                    out, so it must not be modified until the future is done. 
+        @param[in]  data  Object serialisable by pickle.
+        @returns    a concurrent.futures.Future that is done when the message is written.
+        """
+        return self.enqueue(self.encode_whatever(data))
+
+
+    def send_array_async(self, data):
+        """
+        @brief      Same as send_array(), but the array is written by a background thread.
+        @details    The array is not copied, so it must not be modified until the future is
+                    done.
+        @param[in]  data  Numpy.ndarray.
+        @returns    a concurrent.futures.Future that is done when the array is written.
+        """
+        self.check_array_framing('send_array_async')
+        return self.enqueue(self.encode_array(data))
+
+
+    def check_array_framing(self, method):
+        """
+        @brief Raises ValueError if this class sends or receives arrays in a different way 
+               than Pipe (e.g. SharedMemoryPipe or UnixSocketPipe), since 'method' writes or
+               reads the messages of Pipe.send_array().
+        """
+        cls = type(self)
+        if cls.send_array is not Pipe.send_array or cls.recv_array is not Pipe.recv_array:
+            raise ValueError(method + '() is not supported by ' + type(self).__name__ + '.')
+
+
+    def enqueue(self, buffers):
+        """
+        @brief      Hands an encoded message to the writer thread, applying the backpressure
+                    policy if the queue is full.
+        @returns    a concurrent.futures.Future.
+        """
+        # Messages queued by send_whatever() before this one go first
+        self.write_queued()
+
+        future = concurrent.futures.Future()
+        with self.async_cond:
+            if self.writer is None:
+                self.writer_stop = False
+                self.writer = threading.Thread(target=self.write_async, daemon=True)
+                self.writer.start()
+            while len(self.async_queue) >= self.async_queue_size:
+                if self.backpressure == 'raise':
+                    raise BlockingIOError('The queue of messages to be sent is full.')
+                if self.backpressure == 'drop_oldest':
+                    self.async_queue.popleft()[1].cancel()
+                else:
+                    self.async_cond.wait()
+            self.async_queue.append((buffers, future))
+            self.async_cond.notify_all()
+        return future
+
+
+    def write_async(self):
+        """
+        @brief Writer thread, writes the messages of enqueue() in order until cleanup().
+        """
+        while True:
+            with self.async_cond:
+                while not self.async_queue and not self.writer_stop:
+                    self.async_cond.wait()
+                if not self.async_queue:
+                    return
+                buffers, future = self.async_queue.popleft()
+                self.async_writing = True
+                self.async_cond.notify_all()
+            try:
+                if future.set_running_or_notify_cancel():
+                    with self.send_lock:
+                        if self.credit_pipe is not None:
+                            self.take_credit(Pipe.message_bytes(buffers))
+                        self.write_buffers(buffers)
+                    future.set_result(None)
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self.async_cond:
+                    self.async_writing = False
+                    self.async_cond.notify_all()
+
+
+    def wait_async(self):
+        """
+        @brief Blocks until the writer thread has written all the messages it was given.
+        """
+        with self.async_cond:
+            while self.async_queue or self.async_writing:
+                self.async_cond.wait()
+
+
+    def recv_many(self, max_items=1024, timeout=None):
+        """
+        @brief      Receives up to 'max_items' objects sent with send_whatever() or 
+                    send_many().
+        @details    Everything that is available is read at once (up to 1MB), and all the 
+                    complete messages in it are decoded without more system calls.
+        @param[in]  max_items  Maximum number of objects returned.
+        @param[in]  timeout    Maximum number of seconds to wait for the first object, None 
+                               waits forever.
+        @returns    a list of objects, empty if the timeout expires.
+        """
+        if self.prefetched is not None:
+            items = [self.recv_prefetched('whatever', timeout)]
+            if items[0] is None:
+                return []
+            while len(items) < max_items and not self.prefetched.empty():
+                items.append(self.recv_prefetched('whatever'))
+            return items
+
+        self.write_queued(blocking=False)
+        items = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(items) < max_items:
+            # Decode the messages that are already complete
+            if self.read_ahead_complete():
+                items.append(self.run_decoder(self.decode_whatever()))
+                continue
+            
+            # Read more data, waiting only if we do not have anything to return yet
+            if items:
+                timeout_ms = 0
+            elif deadline is None:
+                timeout_ms = -1
+            else:
+                timeout_ms = max(0, int((deadline - time.monotonic()) * 1000))
+            if not self.poll.poll(timeout_ms):
+                if items or deadline is not None:
+                    break
+                continue
+            if self.metrics is None:
+                chunk = os.read(self.read_pipe, 1024 * 1024)
+            else:
+                tic = time.perf_counter_ns()
+                chunk = os.read(self.read_pipe, 1024 * 1024)
+                self.metrics.io('read', len(chunk), len(chunk), time.perf_counter_ns() - tic)
+            if not chunk:
+                # Return what was received before the other end closed the pipe
+                if items:
+                    break
+                raise IOError('The other end closed the pipe.')
+            del self.read_ahead[:self.read_ahead_pos]
+            self.read_ahead_pos = 0
+            self.read_ahead += chunk
+        return items
+
+
+    def read_ahead_complete(self):
+        """
+        @returns True if the data read ahead contains a whole send_whatever() message.
+        """
+        lensize_format = BaseIPC.lensize_dict[self.lensize]
+        available = len(self.read_ahead) - self.read_ahead_pos
+        if available < self.lensize + 4:
+            return False
+        length = struct.unpack_from(lensize_format, self.read_ahead, self.read_ahead_pos)[0]
+        nbuffers = struct.unpack_from('>I', self.read_ahead, self.read_ahead_pos + self.lensize)[0]
+        if nbuffers & Pipe.SERIALIZED:
+            return available >= self.lensize + 4 + length
+        codec_id, nbuffers = nbuffers >> 24, nbuffers & 0xffffff
+        nlengths = 2 * nbuffers if codec_id else nbuffers
+        needed = self.lensize + 4 + nlengths * self.lensize + length
+        if available < needed - length:
+            return False
+        lengths = struct.unpack_from('>' + nlengths * lensize_format[1:], self.read_ahead, 
+            self.read_ahead_pos + self.lensize + 4)
+        return available >= needed + sum(lengths[::2] if codec_id else lengths)
+
+
+    def recv_array(self, blocking=True, out=None, timeout=None):
+        """ 
+        @brief      Pickle is quite slow for large numpy arrays, so we have this dedicated method.
+        @details    This is a blocking operation (if there is no data available). The body
+                    is read directly into the memory of the returned array, which is writable.
+                    The array is 'out' if given, otherwise it is taken from the pool of 
+                    recycled arrays or newly allocated.
+        @param[in]  out      C-contiguous numpy.ndarray with the shape and dtype of the array 
+                             that is going to be received.
+        @param[in]  timeout  Maximum number of seconds to wait for the array to start 
+                             arriving, None waits forever.
+        @returns    a numpy.ndarray. If blocking is False and there is nothing to be read, or
+                    the timeout expires, it returns None.
+        """
+        timeout = 0 if not blocking else timeout
+        if self.prefetched is not None:
+            data = self.recv_prefetched('array', timeout)
+            if data is None or out is None:
+                return data
+            np.copyto(self.get_array(data.shape, data.dtype, out), data)
+            self.recycle(data)
+            return out
+        self.write_queued(blocking=False)
+        if not self.wait_readable(timeout):
+            return None
+        return self.run_decoder(self.decode_array(out))
+
+
+    def send_buffer(self, data):
+        """
+        @brief      Sends an object that supports the buffer protocol (bytes, bytearray, 
+                    memoryview, array.array, numpy arrays...) or that has an adapter (torch
+                    CPU tensors, PIL images), see register_buffer_adapter().
+        @details    The bytes of the object are written from its own memory, only the name
+                    of its adapter and its metadata (e.g. format and shape) are pickled. The
+                    message is a send_whatever() message, see recv_buffer().
+        @param[in]  data  Object to send.
+        @returns    nothing.
+        """
+        adapter = next((a for a in BUFFER_ADAPTERS.values() if a.accepts(data)))
+        try:
+            buf, meta = adapter.to_buffer(data)
+            view = memoryview(buf)
+        except TypeError:
+            raise ValueError('Objects of type ' + type(data).__name__ + ' do not support the '
+                + 'buffer protocol and there is no adapter for them.')
+        if not view.c_contiguous:
+            view = memoryview(view.tobytes())
+        self.send_whatever(('buffer', adapter.name, meta, pickle.PickleBuffer(view)))
+
+
+    def recv_buffer(self, blocking=True, timeout=None, raw=False):
+        """
+        @brief      Receives an object sent with send_buffer().
+        @details    Numpy arrays, torch tensors and memoryviews use the memory the bytes 
+                    were received into. Bytes, bytearrays and array.arrays are copied.
+        @param[in]  timeout  Maximum number of seconds to wait, None waits forever.
+        @param[in]  raw      If True, a memoryview of the bytes is returned instead of an 
+                             object of the type that was sent.
+        @returns    the object, or None if blocking is False and there is nothing to be read,
+                    or the timeout expires.
+        """
+        message = self.recv_whatever(blocking, timeout)
+        if message is None:
+            return None
+        _, name, meta, buf = message
+        buf = np.frombuffer(buf, dtype=np.uint8)
+        if raw:
+            return memoryview(buf)
+        if name not in BUFFER_ADAPTERS:
+            raise ValueError('There is no buffer adapter called ' + str(name) + '.')
+        return BUFFER_ADAPTERS[name].from_buffer(buf, meta)
+
+
+    def open_array_stream(self, shape, dtype, depth=2):
+        """
+        @brief      Starts sending arrays that all have the same shape and dtype, e.g. video
+                    frames. The other end has to call accept_array_stream().
+        @details    The shape and dtype are sent once, after that each array is just a 
+                    sequence number and its bytes.
+        @param[in]  shape  Shape of the arrays.
+        @param[in]  dtype  Dtype of the arrays.
+        @param[in]  depth  Number of buffers the receiver cycles through, i.e. number of 
+                           received arrays that stay valid at the same time.
+        @returns    an ArrayStream, use send() and close() on it.
+        """
+        stream = ArrayStream(self, shape, dtype, depth)
+        self.send_whatever(('stream', stream.shape, stream.dtype, depth))
+        return stream
+
+
+    def accept_array_stream(self, blocking=True, timeout=None):
+        """
+        @brief      Receives the schema sent by open_array_stream() on the other end and 
+                    allocates the buffers of the stream.
+        @returns    an ArrayStream, use recv() on it. None if blocking is False and there is
+                    nothing to be read, or the timeout expires.
+        """
+        message = self.recv_whatever(blocking, timeout)
+        if message is None:
+            return None
+        if not isinstance(message, tuple) or message[0] != 'stream':
+            raise IOError('Expected the schema of an array stream, received ' 
+                + type(message).__name__ + '.')
+        _, shape, dtype, depth = message
+        return ArrayStream(self, shape, dtype, depth, receiver=True)
+
+
+    def start_prefetch(self, depth=2, kind='array'):
+        """
+        @brief      Starts a thread that receives and decodes the next messages before they
+                    are asked for, so that recv_array() or recv_whatever() return straight
+                    away when the consumer is slower than the transfer.
+        @details    All the messages from now on must be of the same kind, as the reader 
+                    thread does not know what the next message is otherwise.
+        @param[in]  depth  Maximum number of messages received ahead, each one takes memory.
+        @param[in]  kind   'array' for send_array() messages, 'whatever' for send_whatever().
+        @returns    nothing.
+        """
+        if kind not in ('array', 'whatever'):
+            raise ValueError('Messages can be prefetched as \'array\' or \'whatever\'.')
+        if self.prefetched is not None:
+            raise ValueError('The pipe is already prefetching.')
+        if kind == 'array':
+            self.check_array_framing('start_prefetch')
+        self.flush()
+        self.prefetch_kind = kind
+        self.prefetched = queue.Queue(maxsize=depth)
+        threading.Thread(target=self.prefetch, daemon=True).start()
+
+
+    def prefetch(self):
+        """
+        @brief Reader thread of start_prefetch(). An error (e.g. the other end closing the 
+               pipe) is handed to the consumer and stops the thread.
+        """
+        decoder = self.decode_array if self.prefetch_kind == 'array' else self.decode_whatever
+        while True:
+            try:
+                message = self.run_decoder(decoder())
+            except Exception as e:
+                self.prefetched.put((False, e))
+                return
+            self.prefetched.put((True, message))
+
+
+    def recv_prefetched(self, kind, timeout=None):
+        """
+        @param[in]  kind     Kind of message expected, see start_prefetch().
+        @param[in]  timeout  Maximum number of seconds to wait, None waits forever.
+        @returns    the next message received by the reader thread, or None if the timeout
+                    expires.
+        """
+        if kind != self.prefetch_kind:
+            raise ValueError('The pipe is prefetching ' + self.prefetch_kind + ' messages.')
+        self.write_queued(blocking=False)
+        try:
+            ok, message = self.prefetched.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if not ok:
+            # Keep the error for the next calls, the reader thread has stopped
+            self.prefetched.put((False, message))
+            raise message
+        return message
+
+
+    def prefetch_depth(self):
+        """
+        @returns the number of messages received ahead and waiting to be taken.
+        """
+        return 0 if self.prefetched is None else self.prefetched.qsize()
+
+
+    def send_array_stream(self, shape, dtype, chunks):
+        """
+        @brief      Sends an array that does not need to be in memory at once.
+        @details    The message is the same as that of send_array(), so the other end can
+                    receive it with recv_array() or recv_array_stream(). Each chunk is 
+                    written as soon as it is produced, so producer and consumer overlap and
+                    only one chunk is in memory at a time.
+        @param[in]  shape   Shape of the whole array.
+        @param[in]  dtype   Dtype of the whole array.
+        @param[in]  chunks  Iterable of numpy arrays of the given dtype whose elements, 
+                            concatenated in C order, are the elements of the whole array.
+                            They can have any shape, e.g. slices along the first axis.
+        @returns    nothing.
+        """
+        self.check_array_framing('send_array_stream')
+        if self.stripes > 1:
+            raise ValueError('Array streams are not supported by pipes with stripes.')
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        flags, descr = self.encode_dtype(dtype)
+        body_len = int(np.prod(shape)) * dtype.itemsize
+        header = self.encode_array_header(shape, flags, descr, body_len)
+        
+        self.flush()
+        with self.send_lock:
+            if self.credit_pipe is not None:
+                self.take_credit(len(header) + body_len)
+            self.write_buffers([header])
+            sent = 0
+            for chunk in chunks:
+                chunk = np.asarray(chunk)
+                if chunk.dtype != dtype:
+                    raise ValueError('Chunk of dtype ' + str(chunk.dtype) + ' in a stream of ' 
+                        + str(dtype) + '.')
+                if sent + chunk.nbytes > body_len:
+                    raise ValueError('The chunks are larger than the array.')
+                self.write_buffers([np.ascontiguousarray(chunk).reshape(-1).view(np.uint8)])
+                sent += chunk.nbytes
+
+            # The other end is waiting for the rest of the array, so the pipe is unusable
+            if sent != body_len:
+                raise ValueError('The chunks are smaller than the array, the pipe is now out '
+                    + 'of sync.')
+
+
+    def recv_array_stream(self, chunk_bytes=64 * 1024 * 1024, out=None):
+        """
+        @brief      Receives an array in chunks of rows, so it does not need to fit in memory.
+        @details    It is a generator. Without 'out', the chunks are views of a buffer of 
+                    about 'chunk_bytes' that is reused for the next chunk, so they have to 
+                    be consumed (or copied) before asking for the next one. With 'out', e.g. 
+                    a numpy.memmap, the array is read straight into it and the chunks are 
+                    views of 'out'. If the generator is closed early, the rest of the array 
+                    is discarded.
+        @param[in]  chunk_bytes  Approximate size of the chunks. Chunks have at least one 
+                                 row (a slice along the first axis).
+        @param[in]  out          Numpy.ndarray with the shape and dtype of the array.
+        @returns    numpy.ndarray chunks of whole rows, in order.
+        """
+        self.check_array_framing('recv_array_stream')
+        if self.stripes > 1:
+            raise ValueError('Array streams are not supported by pipes with stripes.')
+        self.write_queued(blocking=False)
+        body_len, shape, dtype, fortran, codec_id = self.run_decoder(self.decode_array_header())
+        if self.grant_pipe is not None:
+            # The body is granted in advance, the header was granted as the message
+            self.grant(body_len, messages=0)
+        if not codec_id and body_len != int(np.prod(shape)) * dtype.itemsize:
+            self.run_decoder(self.decode_discard(body_len), message=False)
+            raise IOError('The size of the array is different than expected.')
+
+        # Fortran-ordered arrays are streamed as the rows of their transpose
+        rows_shape = shape[::-1] if fortran else shape
+        if out is not None:
+            try:
+                target = self.get_array(rows_shape, dtype, out.T if fortran else out)
+            except ValueError:
+                self.run_decoder(self.decode_discard(body_len), message=False)
+                raise
+        if len(rows_shape) == 0:
+            rows_shape = (1, )
+        rows = rows_shape[0]
+        row_bytes = int(np.prod(rows_shape[1:])) * dtype.itemsize
+        rows_per_chunk = max(1, chunk_bytes // row_bytes) if row_bytes > 0 else max(rows, 1)
+        if out is None:
+            buf = np.empty((min(rows, rows_per_chunk), ) + rows_shape[1:], dtype=dtype)
+        else:
+            target = target.reshape(rows_shape)
+
+        # Compressed arrays cannot be decompressed in pieces, they are received whole
+        received = 0
+        if codec_id:
+            compressed = bytearray(body_len)
+            self.read_into(compressed)
+            received = body_len
+            if out is None:
+                target = np.empty(rows_shape, dtype=dtype)
+            self.decompress_into(codec_id, compressed, target.reshape(-1).view(np.uint8))
+            for start in range(0, rows, rows_per_chunk):
+                chunk = target[start:start + rows_per_chunk]
+                yield chunk.T if fortran else chunk
+            return
+
+        try:
+            for start in range(0, rows, rows_per_chunk):
+                nrows = min(rows_per_chunk, rows - start)
+                chunk = buf[:nrows] if out is None else target[start:start + nrows]
+                self.read_into(chunk.reshape(-1).view(np.uint8))
+                received += chunk.nbytes
+                yield chunk.T if fortran else chunk
+        finally:
+            # Keep the pipe in sync if the consumer stops early
+            if received < body_len:
+                self.run_decoder(self.decode_discard(body_len - received), message=False)
+
+
+    def get_array(self, shape, dtype, out=None):
+        """
+        @brief      Provides the array where a received array is going to be stored.
+        @param[in]  shape  Shape of the received array.
+        @param[in]  dtype  Dtype of the received array.
+        @param[in]  out    Array provided by the caller, if any.
+        @returns    'out' after checking that it is suitable, an array from the pool, or 
+                    a new array.
+        """
+        if out is not None:
+            if out.shape != tuple(shape) or out.dtype != np.dtype(dtype):
+                raise ValueError('Received an array of shape ' + str(tuple(shape)) 
+                    + ' and dtype ' + str(np.dtype(dtype)) + ', but out has shape ' 
+                    + str(out.shape) + ' and dtype ' + str(out.dtype) + '.')
+            if not out.flags.c_contiguous or not out.flags.writeable:
+                raise ValueError('The out array must be C-contiguous and writable.')
+            return out
+        if self.pool is not None:
+            data = self.pool.get(shape, dtype)
+            if data is not None:
+                return data
+        return np.empty(shape, dtype=dtype)
+
+
+    def stats(self):
+        """
+        @brief      Snapshot of the counters and timers enabled with the 'stats' option.
+        @details    Messages are counted when they are encoded or decoded. Time is in 
+                    nanoseconds: blocked in read/write system calls (a full or empty pipe,
+                    i.e. a slow peer), in pickle, and encoding or decoding array headers.
+                    The histograms of the timers are in the key 'histograms'.
+        @returns    a dictionary, or None if stats are not enabled.
+        """
+        if self.metrics is None:
+            return None
+        snapshot = self.metrics.snapshot()
+        snapshot['histograms'] = self.metrics.histograms()
+        return snapshot
+
+
+    def recycle(self, data):
+        """
+        @brief      Gives back an array returned by recv_array() so that its memory is 
+                    reused to receive other arrays. Does nothing if the pool is disabled.
+        @param[in]  data  Numpy.ndarray that the caller will not use anymore.
+        @returns    nothing.
+        """
+        if self.pool is not None:
+            self.pool.put(data)
+
+
+    def send_array(self, data):
+        """ 
+        @brief      Pickle is quite slow for large numpy arrays, so we have this dedicated method.
+
+        @details    This is a blocking operation. It blocks when the pipe is full.
+                    A pipe has a limited capacity (typically 16 pages). This method will block 
+                    until data has been read and there is space again. See encode_array()
+                    for the structure of the message.
+    
+        @param[in]  data  Numpy.ndarray.
+        @returns    nothing.
+        """
+        buffers = self.encode_array(data)
+        self.flush()
+        with self.send_lock:
+            if self.credit_pipe is not None:
+                self.take_credit(Pipe.message_bytes(buffers))
+            self.write_buffers(buffers)
+        
+
+class ArrayStream:
+
+    # Sequence number that ends the stream
+    END = (1 << 64) - 1
+
+    def __init__(self, pipe, shape, dtype, depth, receiver=False):
+        """
+        @brief      Stream of arrays of a fixed shape and dtype, see Pipe.open_array_stream().
+        @details    Message structure: [ seq | body ], 8 bytes with the sequence number 
+                    followed by the bytes of the array. A sequence number of END closes the
+                    stream, the pipe is back to normal messages after it.
+        @returns    nothing.
+        """
+        self.pipe = pipe
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.depth = depth
+        self.seq = 0
+        self.closed = False
+        self.seq_buf = bytearray(8)
+        if receiver:
+            self.buffers = [np.empty(self.shape, dtype=self.dtype) for _ in range(depth)]
+            self.views = [b.reshape(-1).view(np.uint8) for b in self.buffers]
+
+
+    def send(self, data):
+        """
+        @brief      Sends the next array of the stream.
+        @param[in]  data  Numpy.ndarray with the shape and dtype of the stream.
+        @returns    nothing.
+        """
+        if data.shape != self.shape or data.dtype != self.dtype:
+            raise ValueError('The stream is of shape ' + str(self.shape) + ' and dtype ' 
+                + str(self.dtype) + ', but the array has shape ' + str(data.shape) 
+                + ' and dtype ' + str(data.dtype) + '.')
+        body = np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+        self.pipe.flush()
+        with self.pipe.send_lock:
+            if self.pipe.credit_pipe is not None:
+                self.pipe.take_credit(8 + body.nbytes)
+            self.pipe.write_buffers([struct.pack('>Q', self.seq), body])
+        self.seq += 1
+
+
+    def close(self):
+        """
+        @brief Ends the stream.
+        """
+        self.pipe.flush()
+        with self.pipe.send_lock:
+            if self.pipe.credit_pipe is not None:
+                self.pipe.take_credit(8)
+            self.pipe.write_buffers([struct.pack('>Q', ArrayStream.END)])
+        self.closed = True
+
+
+    def recv(self, blocking=True, timeout=None):
+        """
+        @brief      Receives the next array of the stream into the next of the 'depth' 
+                    buffers, so it stays valid until 'depth' more arrays are received.
+        @details    The sequence number of the array is in 'seq'.
+        @returns    a numpy.ndarray, or None if the stream is closed, if blocking is False 
+                    and there is nothing to be read, or if the timeout expires.
+        """
+        if self.closed:
+            return None
+        timeout = 0 if not blocking else timeout
+        if not self.pipe.wait_readable(timeout):
+            return None
+        self.pipe.read_into(self.seq_buf)
+        seq = struct.unpack('>Q', self.seq_buf)[0]
+        if seq == ArrayStream.END:
+            self.closed = True
+            if self.pipe.grant_pipe is not None:
+                self.pipe.grant(8)
+            return None
+        index = seq % self.depth
+        self.pipe.read_into(self.views[index])
+        if self.pipe.grant_pipe is not None:
+            self.pipe.grant(8 + self.views[index].nbytes)
+        self.seq = seq
+        return self.buffers[index]
+
+
+    def __iter__(self):
+        """
+        @brief Yields the arrays of the stream until it is closed.
+        """
+        while True:
+            data = self.recv()
+            if data is None:
+                return
+            yield data
+
+
+class SharedMemoryPipe(Pipe):
+
+    def __init__(self, pipe_name, slots=4, slot_size=128 * 1024 * 1024, lensize=8, 
+            header_len=128, pool_size=0):
+        """
+        @brief      Pipe that moves the bodies of numpy arrays through shared memory.
+        @details    Each end creates a shared memory segment for the arrays it sends, 
+                    divided in 'slots' slots of 'slot_size' bytes. The FIFOs are only used
+                    to tell the other end in which slot the array is, and its shape and
+                    dtype. Arrays that do not fit in a slot are sent through the FIFOs.
+                    
+                    An extra FIFO per direction carries the indices of the slots released
+                    by the receiver, the sender blocks on it when all its slots are in use.
+
+        @param[in]  pipe_name  String with the name of the pipe, same for server and client.
+        @param[in]  slots      Number of arrays that can be in flight at the same time.
+        @param[in]  slot_size  Maximum size (in bytes) of an array sent through shared memory.
+                               It is rounded up to a multiple of the page size so that all
+                               the slots are aligned.
+        @returns    nothing.
+        """
+        super().__init__(pipe_name, lensize, header_len, pool_size)
+        self.slots = slots
+        self.slot_size = (slot_size + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+        self.send_shm = None
+        self.recv_shm = None
+        self.free_slots = collections.deque(range(slots))
+        self.held_slots = set()
+        self.release_read_pipe = None
+        self.release_write_pipe = None
+
+    @staticmethod
+    def attach(name):
+        """
+        @brief   Attach to a shared memory segment created by the other end.
+        @details The segment is not registered with the resource tracker, which would 
+                 otherwise unlink it when this process exits, but it belongs to the other 
+                 process. Registering and unregistering it instead would also remove the 
+                 registration of the other end when both share the tracker (after fork).
+        """
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, track=False)
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+    def listen(self):
+        """
+        @brief Blocks until a client is connected.
+        """
+        super().listen()
+
+        # FIFOs for the released slots, opened in the same order as the data FIFOs
+        self.release_read_pipe = self.open_release_pipe('_server_release', os.O_RDONLY)
+        self.release_write_pipe = self.open_release_pipe('_client_release', os.O_WRONLY)
+        self.exchange_segments()
+
+
+    def connect(self):
+        """
+        @brief Blocks until a server starts listening.
+        """
+        super().connect()
+        self.release_write_pipe = self.open_release_pipe('_server_release', os.O_WRONLY)
+        self.release_read_pipe = self.open_release_pipe('_client_release', os.O_RDONLY)
+        self.exchange_segments()
+
+
+    def open_release_pipe(self, suffix, flags):
+        name = os.path.join(tempfile.gettempdir(), '.' + self.pipe_name + suffix)
+        Pipe.mkpipe(name)
+        return os.open(name, flags)
+
+
+    def exchange_segments(self):
+        """
+        @brief Creates the segment for the arrays we send and attaches to the segment of the
+               arrays we receive.
+        """
+        # Create our segment
+        self.send_shm = shared_memory.SharedMemory(create=True, 
+            size=self.slots * self.slot_size)
+
+        # Tell the other end where to find it (the message is small, so it does not block)
+        Pipe.send_whatever(self, {'name': self.send_shm.name, 'slots': self.slots, 
+            'slot_size': self.slot_size})
+
+        # Attach to the segment of the other end
+        info = Pipe.recv_whatever(self)
+        self.recv_shm = SharedMemoryPipe.attach(info['name'])
+        self.recv_slots = info['slots']
+        self.recv_slot_size = info['slot_size']
+        base = np.frombuffer(self.recv_shm.buf, dtype=np.uint8, count=1)
+        self.recv_address = base.ctypes.data
+        del base
+
+
+    def cleanup(self):
+        for shm in (self.recv_shm, self.send_shm):
+            if shm is not None:
+                try:
+                    shm.close()
+                except BufferError:
+                    # The user still holds arrays backed by the segment
+                    pass
+        if self.send_shm is not None:
+            try:
+                self.send_shm.unlink()
+            except FileNotFoundError:
+                pass
+        for fd in (self.release_read_pipe, self.release_write_pipe):
+            if fd is not None:
+                os.close(fd)
+        self.recv_shm = None
+        self.send_shm = None
+        self.release_read_pipe = None
+        self.release_write_pipe = None
+        super().cleanup()
+
+
+    def acquire_slot(self):
+        """
+        @brief   Blocks until one of our slots has been released by the other end.
+        @returns the index of a free slot.
+        """
+        if not self.free_slots:
+            # Each release notice is a 4-byte write, so it is never split by the pipe
+            released = os.read(self.release_read_pipe, 4 * self.slots)
+            if not released:
+                raise IOError('The other end closed the pipe.')
+            self.free_slots.extend(struct.unpack('>%dI' % (len(released) // 4), released))
+        return self.free_slots.popleft()
+
+
+    def release_slot(self, slot):
+        """
+        @brief Tells the other end that one of its slots can be reused.
+        """
+        try:
+            os.write(self.release_write_pipe, struct.pack('>I', slot))
+        except BrokenPipeError:
+            # The other end is gone, so nobody is going to reuse the slot
+            pass
+
+
+    def send_array(self, data):
+        """ 
+        @brief      Copies the array into a free slot and sends its location through the FIFO.
+        @details    This is a blocking operation. It blocks when all the slots are in use, 
+                    until the other end calls release() on one of the arrays it received.
+        @param[in]  data  Numpy.ndarray.
+        @returns    nothing.
+        """
+        if data.nbytes > self.slot_size:
+            Pipe.send_whatever(self, ('inline',))
+            Pipe.send_array(self, data)
+            return
+
+        # Copy the array into shared memory
+        slot = self.acquire_slot()
+        dst = np.ndarray(data.shape, dtype=data.dtype, buffer=self.send_shm.buf, 
+            offset=slot * self.slot_size)
+        np.copyto(dst, data)
+        del dst
+
+        # Tell the other end where it is
+        Pipe.send_whatever(self, ('shm', slot, data.shape, data.dtype))
+
+
+    def recv_array(self, blocking=True, out=None, timeout=None):
+        """ 
+        @brief      Receives an array that lives in the shared memory segment of the other end.
+        @details    The slot stays in use until release() is called with the returned array,
+                    after that the contents of the array can be overwritten at any time.
+                    If 'out' is given, the array is copied into it and the slot is released
+                    straight away.
+        @param[in]  out  C-contiguous numpy.ndarray with the shape and dtype of the array 
+                         that is going to be received.
+        @param[in]  timeout  Maximum number of seconds to wait, None waits forever.
+        @returns    a numpy.ndarray. If blocking is False and there is nothing to be read, or 
+                    the timeout expires, it returns None.
+        """
+        msg = Pipe.recv_whatever(self, blocking, timeout)
+        if msg is None:
+            return None
+        if msg[0] == 'inline':
+            return Pipe.recv_array(self, out=out)
+        
+        _, slot, shape, dtype = msg
+        if out is not None:
+            try:
+                out = self.get_array(shape, dtype, out)
+                np.copyto(out, np.ndarray(shape, dtype=dtype, buffer=self.recv_shm.buf, 
+                    offset=slot * self.recv_slot_size))
+            finally:
+                self.release_slot(slot)
+            return out
+        self.held_slots.add(slot)
+        return np.ndarray(shape, dtype=dtype, buffer=self.recv_shm.buf, 
+            offset=slot * self.recv_slot_size)
+
+
+    def release(self, data):
+        """
+        @brief      Gives the slot of an array returned by recv_array() back to the other end.
+        @param[in]  data  Numpy.ndarray returned by recv_array(). Arrays that were sent 
+                          through the FIFO, and arrays already released, are ignored.
+        @returns    nothing.
+        """
+        offset = data.__array_interface__['data'][0] - self.recv_address
+        if 0 <= offset < self.recv_slots * self.recv_slot_size:
+            slot = offset // self.recv_slot_size
+            if slot in self.held_slots:
+                self.held_slots.remove(slot)
+                self.release_slot(slot)
+        
+
+class AsyncPipe(Pipe):
+
+    def __init__(self, pipe_name, lensize=8, header_len=128, pool_size=0):
+        """
+        @brief      Pipe for asyncio programs, all the methods are coroutines.
+        @details    The FIFOs are non-blocking and driven by the event loop with add_reader()
+                    and add_writer(), so waiting for data or for space in the pipe never
+                    blocks the loop and one loop can serve many pipes. The messages are
+                    the same as those of Pipe, so the other end can use either class.
+        @param[in]  pipe_name  String with the name of the pipe, same for server and client.
+        @returns    nothing.
+        """
+        super().__init__(pipe_name, lensize, header_len, pool_size)
+        self.read_lock = None
+        self.write_lock = None
+
+
+    async def listen(self):
+        """
+        @brief Waits until a client is connected.
+        """
+        # Opening a FIFO blocks until the other end opens it too
+        await asyncio.get_running_loop().run_in_executor(None, Pipe.listen, self)
+        os.set_blocking(self.read_pipe, False)
+        os.set_blocking(self.write_pipe, False)
+
+        # The locks are created here so that they belong to the running loop
+        self.read_lock = asyncio.Lock()
+        self.write_lock = asyncio.Lock()
+
+
+    async def connect(self):
+        """
+        @brief Waits until a server starts listening.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, Pipe.connect, self)
+        os.set_blocking(self.read_pipe, False)
+        os.set_blocking(self.write_pipe, False)
+
+        # The locks are created here so that they belong to the running loop
+        self.read_lock = asyncio.Lock()
+        self.write_lock = asyncio.Lock()
+
+
+    @staticmethod
+    async def wait_fd(fd, write=False):
+        """
+        @brief      Waits until the file descriptor is ready without blocking the event loop.
+        @param[in]  fd     File descriptor.
+        @param[in]  write  True to wait until it is writable, False to wait until it is 
+                           readable.
+        @returns    nothing.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        def callback():
+            if not future.done():
+                future.set_result(None)
+        if write:
+            loop.add_writer(fd, callback)
+        else:
+            loop.add_reader(fd, callback)
+        try:
+            await future
+        finally:
+            if write:
+                loop.remove_writer(fd)
+            else:
+                loop.remove_reader(fd)
+
+
+    async def write_buffers(self, buffers):
+        """
+        @brief Asynchronous version of Pipe.write_buffers().
+        """
+        views = [memoryview(b) for b in buffers]
+        views = [v.cast('B') for v in views if v.nbytes > 0]
+        while views:
+            try:
+                written = os.writev(self.write_pipe, views[:1024])
+            except BlockingIOError:
+                await AsyncPipe.wait_fd(self.write_pipe, write=True)
+                continue
+
+            # Drop what has been written already
+            while views and written >= views[0].nbytes:
+                written -= views[0].nbytes
+                views.pop(0)
+            if written:
+                views[0] = views[0][written:]
+
+
+    async def read_into(self, buf):
+        """
+        @brief Asynchronous version of Pipe.read_into().
+        """
+        view = memoryview(buf)
+        if view.nbytes > 0:
+            view = view.cast('B')
+        while view.nbytes > 0:
+            try:
+                nbytes = os.readv(self.read_pipe, [view])
+            except BlockingIOError:
+                await AsyncPipe.wait_fd(self.read_pipe)
+                continue
+            if nbytes == 0:
+                raise IOError('The other end closed the pipe in the middle of a message.')
+            view = view[nbytes:]
+
+
+    async def run_decoder(self, decoder):
+        """
+        @brief Asynchronous version of Pipe.run_decoder(). Only one message is read at a time.
+        """
+        async with self.read_lock:
+            try:
+                buf = next(decoder)
+                while True:
+                    await self.read_into(buf)
+                    buf = next(decoder)
+            except StopIteration as stop:
+                return stop.value
+
+
+    async def recv_whatever(self):
+        """
+        @returns whatever object sent from the other end.
+        """
+        return await self.run_decoder(self.decode_whatever())
+
+
+    async def send_whatever(self, data):
+        """
+        @brief Sends any object serialisable by pickle.
+        """
+        buffers = self.encode_whatever(data)
+        async with self.write_lock:
+            await self.write_buffers(buffers)
+
+
+    async def recv_array(self, out=None):
+        """
+        @param[in]  out  C-contiguous numpy.ndarray with the shape and dtype of the array 
+                         that is going to be received.
+        @returns    a numpy.ndarray.
+        """
+        return await self.run_decoder(self.decode_array(out))
+
+
+    async def send_array(self, data):
+        """
+        @brief Sends a numpy.ndarray.
+        """
+        buffers = self.encode_array(data)
+        async with self.write_lock:
+            await self.write_buffers(buffers)
+
+
+class SocketPipe(Pipe):
+    """
+    @brief Base of the pipes over a stream socket, which is used in both directions.
+    """
+
+    def setup_poll(self):
+        self.read_pipe = self.sock.fileno()
+        self.write_pipe = self.sock.fileno()
+        self.poll = select.poll()
+        self.poll.register(self.read_pipe, select.POLLIN) 
+
+
+    def cleanup(self):
+        self.stop_writer()
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.listening = False
+        self.connected = False
+
+
+    def write_buffers(self, buffers):
+        """
+        @brief Same as Pipe.write_buffers(), but with sendmsg() on the socket.
+        """
+        views = [memoryview(b) for b in buffers]
+        views = [v.cast('B') for v in views if v.nbytes > 0]
+        while views:
+            if self.metrics is None:
+                written = self.sock.sendmsg(views[:1024])
+            else:
+                tic = time.perf_counter_ns()
+                written = self.sock.sendmsg(views[:1024])
+                self.metrics.io('write', sum(v.nbytes for v in views[:1024]), written, 
+                    time.perf_counter_ns() - tic)
+            while views and written >= views[0].nbytes:
+                written -= views[0].nbytes
+                views.pop(0)
+            if written:
+                views[0] = views[0][written:]
+
+
+    def read_into(self, buf):
+        """
+        @brief Same as Pipe.read_into(), but with recv_into() on the socket.
+        """
+        view = self.take_read_ahead(buf)
+        while view.nbytes > 0:
+            if self.metrics is None:
+                nbytes = self.sock.recv_into(view)
+            else:
+                tic = time.perf_counter_ns()
+                nbytes = self.sock.recv_into(view)
+                self.metrics.io('read', view.nbytes, nbytes, time.perf_counter_ns() - tic)
+            if nbytes == 0:
+                raise IOError('The other end closed the socket in the middle of a message.')
+            view = view[nbytes:]
+
+
+class UnixSocketPipe(SocketPipe):
+
+    def __init__(self, pipe_name, memfd_threshold=1024 * 1024, lensize=8, header_len=128, 
+            pool_size=0):
+        """
+        @brief      Pipe over a Unix domain socket that passes large arrays as file 
+                    descriptors.
+        @details    The body of an array of at least 'memfd_threshold' bytes is written 
+                    once into an anonymous memory file (memfd), and only its descriptor and 
+                    the header cross the socket (SCM_RIGHTS). The receiver maps the file, 
+                    so the time to receive an array does not depend on its size. Smaller
+                    arrays and the messages of send_whatever are sent through the socket.
+        @param[in]  pipe_name        String with the name of the pipe, same for server and 
+                                     client.
+        @param[in]  memfd_threshold  Arrays of at least this many bytes are sent as memfds.
+        @returns    nothing.
+        """
+        super().__init__(pipe_name, lensize, header_len, pool_size)
+        self.memfd_threshold = memfd_threshold
+        self.sock = None
+        self.socket_name = os.path.join(tempfile.gettempdir(), '.' + pipe_name + '.sock')
+
+
+    def listen(self):
+        """
+        @brief Blocks until a client is connected.
+        """
+        if os.path.exists(self.socket_name):
+            os.unlink(self.socket_name)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_name)
+        server.listen(1)
+        self.sock, _ = server.accept()
+        server.close()
+        os.unlink(self.socket_name)
+        self.listening = True
+        self.setup_poll()
+
+
+    def connect(self):
+        """
+        @brief Blocks until a server starts listening.
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        while True:
+            try:
+                self.sock.connect(self.socket_name)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.01)
+        self.connected = True
+        self.setup_poll()
+
+
+    def send_array(self, data):
+        """ 
+        @brief      Sends a numpy.ndarray, through a memfd if it is large.
+
+        @details    Message structure: [ kind | array message ]
+
+                    kind: b'I' if the array message (see Pipe.encode_array) is complete, 
+                          b'M' if the body is in a memfd whose descriptor is attached to 
+                          the kind byte.
+    
+        @param[in]  data  Numpy.ndarray.
+        @returns    nothing.
+        """
+        buffers = self.encode_array(data)
+        self.flush()
+        if data.nbytes < self.memfd_threshold:
+            with self.send_lock:
+                self.write_buffers([b'I'] + buffers)
+            return
+
+        # Write the body into a memfd
+        fd = os.memfd_create(self.pipe_name, os.MFD_CLOEXEC)
+        try:
+            view = memoryview(buffers[-1]).cast('B')
+            while view.nbytes > 0:
+                view = view[os.write(fd, view):]
+
+            # Send the descriptor and the header, without other messages in between
+            with self.send_lock:
+                socket.send_fds(self.sock, [b'M'], [fd])
+                self.write_buffers(buffers[:-1])
+        finally:
+            os.close(fd)
+
+
+    def recv_array(self, blocking=True, out=None, timeout=None):
+        """ 
+        @brief      Receives an array sent by send_array().
+        @details    Arrays sent as memfds are backed by a shared mapping of the file, which
+                    is released when the array is garbage collected.
+        @param[in]  out  C-contiguous numpy.ndarray with the shape and dtype of the array 
+                         that is going to be received. Arrays sent as memfds are copied 
+                         into it.
+        @param[in]  timeout  Maximum number of seconds to wait, None waits forever.
+        @returns    a numpy.ndarray. If blocking is False and there is nothing to be read, or 
+                    the timeout expires, it returns None.
+        """
+        timeout = 0 if not blocking else timeout
+        self.write_queued(blocking=False)
+        if not self.wait_readable(timeout):
+            return None
+        kind, fds, _, _ = socket.recv_fds(self.sock, 1, 1)
+        if not kind:
+            raise IOError('The other end closed the socket.')
+        if kind == b'I':
+            return self.run_decoder(self.decode_array(out))
+
+        # Map the memfd
+        try:
+            body_len, shape, dtype, fortran, codec_id = self.run_decoder(self.decode_array_header())
+            if codec_id:
+                data = np.empty(shape[::-1] if fortran else shape, dtype=dtype)
+                self.decompress_into(codec_id, mmap.mmap(fds[0], body_len), 
+                    data.reshape(-1).view(np.uint8))
+                data = data.T if fortran else data
+            elif body_len != int(np.prod(shape)) * dtype.itemsize:
+                raise IOError('The size of the array is different than expected.')
+            else:
+                data = np.frombuffer(mmap.mmap(fds[0], body_len), dtype=dtype)
+                data = data.reshape(shape, order='F' if fortran else 'C')
+        finally:
+            for fd in fds:
+                os.close(fd)
+        if out is not None:
+            out = self.get_array(shape, dtype, out)
+            np.copyto(out, data)
+            return out
+        return data
+
+
+class TcpPipe(SocketPipe):
+
+    def __init__(self, host, port, lensize=8, header_len=128, pool_size=0, 
+            connect_timeout=None):
+        """
+        @brief      Pipe over a TCP connection, to talk to processes on other machines.
+        @details    The messages are the same as those of Pipe. Nagle's algorithm is 
+                    disabled (TCP_NODELAY) so that small messages go out at once, the header
+                    and the body of an array are sent together with sendmsg(), and arrays 
+                    are received with recv_into() straight into their memory.
+        @param[in]  host             Address the server listens on, or that the client 
+                                     connects to, e.g. '127.0.0.1' or '0.0.0.0'.
+        @param[in]  port             TCP port.
+        @param[in]  connect_timeout  Seconds connect() keeps retrying while the server is 
+                                     not listening, None retries forever.
+        @returns    nothing.
+        """
+        super().__init__(host + ':' + str(port), lensize, header_len, pool_size)
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.sock = None
+
+
+    def listen(self):
+        """
+        @brief Blocks until a client is connected.
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((self.host, self.port))
+            server.listen(1)
+            self.sock, _ = server.accept()
+        finally:
+            server.close()
+        self.listening = True
+        self.setup_socket()
+
+
+    def connect(self):
+        """
+        @brief Blocks until a server starts listening.
+        """
+        deadline = None if self.connect_timeout is None else time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                self.sock = socket.create_connection((self.host, self.port))
+                break
+            except ConnectionRefusedError:
+                if deadline is not None and time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        self.connected = True
+        self.setup_socket()
+
+
+    def setup_socket(self):
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.setup_poll()
+
+
+class TcpPipePool:
+
+    def __init__(self, lensize=8, header_len=128, pool_size=0, connect_timeout=None):
+        """
+        @brief      Connections of a client to many TCP servers, opened the first time each 
+                    server is used and kept open to be reused.
+        @details    The options are those of TcpPipe. Each connection carries one 
+                    conversation at a time, so threads talking to the same server have to 
+                    take turns (e.g. holding the lock returned by lock()).
+        @returns    nothing.
+        """
+        self.options = (lensize, header_len, pool_size, connect_timeout)
+        self.pipes = {}
+        self.locks = collections.defaultdict(threading.RLock)
+        self.mutex = threading.Lock()
+
+
+    def get(self, host, port):
+        """
+        @returns the TcpPipe connected to the server, connecting it if needed.
+        """
+        with self.lock(host, port):
+            pipe = self.pipes.get((host, port))
+            if pipe is None:
+                pipe = TcpPipe(host, port, *self.options)
+                pipe.connect()
+                self.pipes[(host, port)] = pipe
+            return pipe
+
+
+    def lock(self, host, port):
+        """
+        @returns a threading.RLock to hold while using the connection to the server.
+        """
+        with self.mutex:
+            return self.locks[(host, port)]
+
+
+    def discard(self, host, port):
+        """
+        @brief Closes the connection to a server, e.g. after an error, the next get() opens 
+               a new one.
+        """
+        with self.lock(host, port):
+            pipe = self.pipes.pop((host, port), None)
+            if pipe is not None:
+                pipe.cleanup()
+
+
+    def cleanup(self):
+        for address in list(self.pipes):
+            self.discard(*address)
+
+
+class PipeSelector:
+
+    def __init__(self, pipes=()):
+        """
+        @brief      Waits for messages on many pipes at the same time.
+        @details    The input FIFO of each pipe is registered once with an epoll object, so
+                    waiting does not depend on the number of pipes. A pipe whose other end
+                    has closed is also returned, its next recv_* raises IOError.
+        @param[in]  pipes  Connected Pipe objects (or subclasses) to watch.
+        @returns    nothing.
+        """
+        self.epoll = select.epoll()
+        self.pipes = {}
+        for pipe in pipes:
+            self.register(pipe)
+
+
+    def register(self, pipe):
+        self.epoll.register(pipe.read_pipe, select.EPOLLIN)
+        self.pipes[pipe.read_pipe] = pipe
+
+
+    def unregister(self, pipe):
+        self.epoll.unregister(pipe.read_pipe)
+        del self.pipes[pipe.read_pipe]
+
+
+    def select(self, timeout=None):
+        """
+        @param[in]  timeout  Maximum number of seconds to wait, None waits forever.
+        @returns    the list of pipes with data to be read, empty if the timeout expires.
+        """
+        # Data read ahead by recv_many() is not seen by epoll
+        buffered = [p for p in self.pipes.values() if p.read_ahead_pos < len(p.read_ahead)]
+        if buffered:
+            timeout = 0
+        events = self.epoll.poll(-1 if timeout is None else timeout)
+        ready = [self.pipes[fd] for fd, _ in events]
+        return ready + [p for p in buffered if all(p is not r for r in ready)]
+
+
+    def close(self):
+        self.epoll.close()
+        self.pipes = {}
+
+
+def wait(pipes, timeout=None):
+    """
+    @brief      Waits until at least one of the pipes has data to be read. Use a 
+                PipeSelector to wait on the same pipes many times.
+    @param[in]  pipes    Connected Pipe objects (or subclasses).
+    @param[in]  timeout  Maximum number of seconds to wait, None waits forever.
+    @returns    the list of pipes with data to be read, empty if the timeout expires.
+    """
+    selector = PipeSelector(pipes)
+    try:
+        return selector.select(timeout)
+    finally:
+        selector.close()
+
+
+class IncrementalReader:
+
+    def __init__(self, fd, new_decoder):
+        """
+        @brief      Runs decoders (see Pipe.run_decoder) on a non-blocking file descriptor.
+        @details    Each call to feed() reads whatever is available and returns the messages
+                    completed so far, the partial message is kept for the next call.
+        @param[in]  fd           Non-blocking file descriptor.
+        @param[in]  new_decoder  Function that returns a new decoder for the next message.
+        @returns    nothing.
+        """
+        self.fd = fd
+        self.new_decoder = new_decoder
+        self.decoder = None
+        self.view = None
+        self.closed = False
+
+
+    def next_view(self, buf):
+        view = memoryview(buf)
+        return view.cast('B') if view.nbytes > 0 else view
+
+
+    def feed(self):
+        """
+        @returns the list of messages completed with the data available. When the other end
+                 closes the pipe 'closed' is set to True.
+        """
+        messages = []
+        while True:
+            if self.decoder is None:
+                self.decoder = self.new_decoder()
+                self.view = self.next_view(next(self.decoder))
+
+            # Read what is available
+            if self.view.nbytes > 0:
+                try:
+                    nbytes = os.readv(self.fd, [self.view])
+                except BlockingIOError:
+                    return messages
+                if nbytes == 0:
+                    self.closed = True
+                    return messages
+                self.view = self.view[nbytes:]
+
+            # Move on to the next buffer of the message or to the next message
+            if self.view.nbytes == 0:
+                try:
+                    self.view = self.next_view(next(self.decoder))
+                except StopIteration as stop:
+                    messages.append(stop.value)
+                    self.decoder = None
+
+
+class PipeServer:
+
+    def __init__(self, server_name, lensize=8, header_len=128):
+        """
+        @brief      Server for many clients at the same time.
+        @details    Clients (see PipeClient) write the name of a new pipe to a rendezvous 
+                    FIFO, and the server opens a Pipe with that name for each of them. All 
+                    the pipes are watched with a single epoll object, so one thread serves
+                    all the clients.
+        @param[in]  server_name  String with the name of the server, same for the clients.
+        @returns    nothing.
+        """
+        self.server_name = server_name
+        self.lensize = lensize
+        self.header_len = header_len
+        self.rendezvous = None
+        self.rendezvous_writer = None
+        self.epoll = None
+        self.clients = {}
+        self.readers = {}
+        self.messages = collections.deque()
+
+        # Seconds a client that has written its name has to open its pipe, so that a 
+        # client that dies in between does not stop the server
+        self.accept_timeout = 1
+
+        # Register the method cleanup so that it is called on destruction
+        atexit.register(self.cleanup)
+
+    @staticmethod
+    def rendezvous_name(server_name):
+        return os.path.join(tempfile.gettempdir(), '.' + server_name + '_rendezvous')
+
+
+    def listen(self):
+        """
+        @brief Starts accepting clients, it does not block.
+        """
+        name = PipeServer.rendezvous_name(self.server_name)
+        Pipe.mkpipe(name)
+        self.rendezvous = os.open(name, os.O_RDONLY | os.O_NONBLOCK)
+        
+        # Keep the FIFO open for writing as well, otherwise it is always readable (EOF) 
+        # when there are no clients writing to it
+        self.rendezvous_writer = os.open(name, os.O_WRONLY)
+        self.rendezvous_buf = b''
+
+        self.epoll = select.epoll()
+        self.epoll.register(self.rendezvous, select.EPOLLIN)
+
+
+    def accept(self):
+        """
+        @brief Opens the pipes of the clients that have written their names in the 
+               rendezvous FIFO.
+        """
+        try:
+            self.rendezvous_buf += os.read(self.rendezvous, 4096)
+        except BlockingIOError:
+            return
+        *names, self.rendezvous_buf = self.rendezvous_buf.split(b'\n')
+        for name in names:
+            client_id = name.decode('utf-8')
+            pipe = Pipe(client_id, self.lensize, self.header_len)
+            atexit.unregister(pipe.cleanup)
+            try:
+                pipe.listen(self.accept_timeout)
+            except TimeoutError:
+                PipeServer.unlink(pipe)
+                continue
+            os.set_blocking(pipe.read_pipe, False)
+            self.clients[client_id] = pipe
+            self.readers[pipe.read_pipe] = (client_id, 
+                IncrementalReader(pipe.read_pipe, pipe.decode_whatever))
+            self.epoll.register(pipe.read_pipe, select.EPOLLIN)
+
+
+    def disconnect(self, client_id):
+        """
+        @brief Closes the pipes of a client and removes its FIFOs.
+        """
+        pipe = self.clients.pop(client_id)
+        self.epoll.unregister(pipe.read_pipe)
+        del self.readers[pipe.read_pipe]
+        pipe.cleanup()
+        PipeServer.unlink(pipe)
+
+
+    @staticmethod
+    def unlink(pipe):
+        """
+        @brief Removes the FIFOs of the pipe of a client.
+        """
+        for name in (pipe.read_pipe_name, pipe.write_pipe_name):
+            try:
+                os.unlink(name)
+            except FileNotFoundError:
+                pass
+
+
+    def recv(self, timeout=None):
+        """
+        @brief      Waits for a message from any of the clients.
+        @param[in]  timeout  Maximum number of seconds to wait, None waits forever.
+        @returns    a tuple (client_id, message), or None if the timeout expires.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.messages:
+            remaining = -1 if deadline is None else max(0, deadline - time.monotonic())
+            events = self.epoll.poll(remaining)
+            for fd, event in events:
+                if fd == self.rendezvous:
+                    self.accept()
+                    continue
+                client_id, reader = self.readers[fd]
+                for message in reader.feed():
+                    self.messages.append((client_id, message))
+                if reader.closed:
+                    self.disconnect(client_id)
+            if not events and deadline is not None:
+                return None
+        return self.messages.popleft()
+
+
+    def __iter__(self):
+        """
+        @brief Yields tuples (client_id, message) forever.
+        """
+        while True:
+            yield self.recv()
+
+
+    def send_whatever(self, client_id, data):
+        """
+        @brief Sends any object serialisable by pickle to one of the clients.
+        """
+        self.clients[client_id].send_whatever(data)
+
+
+    def send_array(self, client_id, data):
+        """
+        @brief Sends a numpy.ndarray to one of the clients.
+        """
+        self.clients[client_id].send_array(data)
+
+
+    def cleanup(self):
+        for client_id in list(self.clients):
+            self.disconnect(client_id)
+        if self.epoll is not None:
+            self.epoll.close()
+            os.close(self.rendezvous)
+            os.close(self.rendezvous_writer)
+            self.epoll = None
+
+
+class PipeClient(Pipe):
+
+    def __init__(self, server_name, lensize=8, header_len=128, pool_size=0):
+        """
+        @brief      Client of a PipeServer. Once connected it is used as any other Pipe.
+        @param[in]  server_name  String with the name of the server.
+        @returns    nothing.
+        """
+        pipe_name = server_name + '_' + str(os.getpid()) + '_' + uuid.uuid4().hex[:8]
+        super().__init__(pipe_name, lensize, header_len, pool_size)
+        self.server_name = server_name
+
+
+    def connect(self):
+        """
+        @brief Blocks until the server accepts the connection.
+        """
+        # The name is written in a single write smaller than PIPE_BUF, so it is atomic
+        # even if other clients are connecting at the same time
+        name = PipeServer.rendezvous_name(self.server_name)
+        Pipe.mkpipe(name)
+        rendezvous = os.open(name, os.O_WRONLY)
+        os.write(rendezvous, (self.pipe_name + '\n').encode('utf-8'))
+        os.close(rendezvous)
+        super().connect()
+
+
+class Broadcaster:
+
+    def __init__(self, name, depth=2, policy='block', lensize=8, header_len=128):
+        """
+        @brief      Sends the same arrays to many Subscribers with a single copy.
+        @details    Each array is copied once into a shared memory segment, and the 
+                    subscribers only receive its location through a PipeServer. A segment
+                    is reused when all the subscribers that received it have released it.
+        @param[in]  name    String with the name of the broadcaster, same for the 
+                            subscribers.
+        @param[in]  depth   Maximum number of arrays that a subscriber can hold (received 
+                            and not released yet).
+        @param[in]  policy  What to do with a subscriber that holds 'depth' arrays: 'block'
+                            waits until it releases one, 'latest' skips it, so that it 
+                            gets the latest array once it has caught up.
+        @returns    nothing.
+        """
+        if policy not in ('block', 'latest'):
+            raise ValueError('Unknown policy ' + str(policy) + ', it has to be \'block\' or '
+                + '\'latest\'.')
+        self.server = PipeServer(name, lensize, header_len)
+        self.depth = depth
+        self.policy = policy
+        self.segments = {}
+        self.refs = {}
+        self.held = {}
+        self.seq = 0
+
+        # Register the method cleanup so that it is called on destruction
+        atexit.register(self.cleanup)
+
+
+    def listen(self):
+        """
+        @brief Starts accepting subscribers, it does not block.
+        """
+        self.server.listen()
+
+
+    def poll(self, timeout=0):
+        """
+        @brief      Accepts new subscribers and processes the arrays released by them.
+        @param[in]  timeout  Maximum number of seconds to wait for a release, None waits 
+                             forever.
+        @returns    nothing.
+        """
+        message = self.server.recv(timeout)
+        while message is not None:
+            client_id, (_, name) = message
+            if name in self.held.get(client_id, ()):
+                self.held[client_id].remove(name)
+                self.refs[name] -= 1
+            message = self.server.recv(0)
+
+        # Subscribers that are gone do not hold anything
+        for client_id in self.server.clients:
+            self.held.setdefault(client_id, [])
+        for client_id in list(self.held):
+            if client_id not in self.server.clients:
+                for name in self.held.pop(client_id):
+                    self.refs[name] -= 1
+
+
+    def wait_subscribers(self, count, timeout=None):
+        """
+        @brief      Waits until there are at least 'count' subscribers.
+        @returns    True if there are, False if the timeout expires.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.poll()
+        while len(self.held) < count:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            self.poll(0.01)
+        return True
+
+
+    def get_segment(self, nbytes):
+        """
+        @returns a shared memory segment of at least 'nbytes' that no subscriber holds.
+        """
+        for name, refs in self.refs.items():
+            if refs == 0 and self.segments[name].size >= nbytes:
+                return self.segments[name]
+
+        # Free segments that are too small are not going to be used anymore
+        for name in [n for n, refs in self.refs.items() if refs == 0]:
+            self.segments[name].close()
+            self.segments[name].unlink()
+            del self.segments[name], self.refs[name]
+        segment = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.segments[segment.name] = segment
+        self.refs[segment.name] = 0
+        return segment
+
+
+    def publish(self, data):
+        """
+        @brief      Sends an array to all the subscribers.
+        @details    With the 'block' policy it blocks until every subscriber holds less 
+                    than 'depth' arrays.
+        @param[in]  data  Numpy.ndarray.
+        @returns    the number of subscribers that got the array.
+        """
+        self.poll()
+        if self.policy == 'block':
+            while any(len(names) >= self.depth for names in self.held.values()):
+                self.poll(0.01)
+        subscribers = [c for c, names in self.held.items() if len(names) < self.depth]
+        seq = self.seq
+        self.seq += 1
+        if not subscribers:
+            return 0
+
+        # Copy the array into shared memory once
+        segment = self.get_segment(data.nbytes)
+        np.copyto(np.ndarray(data.shape, dtype=data.dtype, buffer=segment.buf), data)
+
+        count = 0
+        for client_id in subscribers:
+            try:
+                self.server.send_whatever(client_id, ('frame', seq, segment.name, data.shape, 
+                    data.dtype))
+            except BrokenPipeError:
+                continue
+            self.held[client_id].append(segment.name)
+            self.refs[segment.name] += 1
+            count += 1
+        return count
+
+
+    def cleanup(self):
+        self.server.cleanup()
+        for segment in self.segments.values():
+            segment.close()
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+        self.segments = {}
+        self.refs = {}
+
+
+class Subscriber:
+
+    def __init__(self, name, lensize=8, header_len=128):
+        """
+        @brief      Receives the arrays of a Broadcaster.
+        @param[in]  name  String with the name of the broadcaster.
+        @returns    nothing.
+        """
+        self.pipe = PipeClient(name, lensize, header_len)
+        self.segments = {}
+        self.frames = {}
+        self.seq = None
+        self.skipped = 0
+
+        # Register the method cleanup so that it is called on destruction
+        atexit.register(self.cleanup)
+
+
+    def connect(self):
+        """
+        @brief Blocks until the broadcaster accepts the subscriber, which happens on its 
+               next call to publish(), poll() or wait_subscribers().
+        """
+        self.pipe.connect()
+
+
+    def recv(self, timeout=None):
+        """
+        @brief      Receives the next array. The array lives in shared memory and it must 
+                    be given back with release(), its contents can change after that.
+        @details    The number of arrays that this subscriber missed because it was slow 
+                    (see the 'latest' policy of Broadcaster) is kept in 'skipped'.
+        @param[in]  timeout  Maximum number of seconds to wait, None waits forever.
+        @returns    a read-only numpy.ndarray, or None if the timeout expires.
+        """
+        message = self.pipe.recv_whatever(timeout=timeout)
+        if message is None:
+            return None
+        _, seq, name, shape, dtype = message
+        if self.seq is not None:
+            self.skipped += seq - self.seq - 1
+        self.seq = seq
+        if name not in self.segments:
+            self.segments[name] = SharedMemoryPipe.attach(name)
+        data = np.ndarray(shape, dtype=dtype, buffer=self.segments[name].buf)
+        data.flags.writeable = False
+        self.frames[data.__array_interface__['data'][0]] = name
+        return data
+
+
+    def release(self, data):
+        """
+        @brief      Tells the broadcaster that an array returned by recv() is not needed 
+                    anymore.
+        @param[in]  data  Numpy.ndarray returned by recv().
+        @returns    nothing.
+        """
+        name = self.frames.pop(data.__array_interface__['data'][0])
+        self.pipe.send_whatever(('release', name))
+
+
+    def cleanup(self):
+        self.pipe.cleanup()
+        for segment in self.segments.values():
+            try:
+                segment.close()
+            except BufferError:
+                # The user still holds arrays backed by the segment
+                pass
+        self.segments = {}
+
+
+class RpcServer:
+
+    def __init__(self, pipe_name, functions, workers=4, executor=None):
+        """
+        @brief      Serves the calls of an RpcClient with a pool of workers.
+        @details    Requests are read as they arrive and handed to the workers, and each
+                    response is sent as soon as it is ready, so many calls are in flight at
+                    the same time and they can finish in any order.
+
+                    Request : (request id, function name, args, kwargs)
+                    Response: (request id, True, result) or (request id, False, exception)
+
+        @param[in]  pipe_name  String with the name of the pipe, same for server and client.
+        @param[in]  functions  Dictionary {name: function} of the functions that can be called.
+        @param[in]  workers    Number of threads of the pool.
+        @param[in]  executor   concurrent.futures.Executor to use instead of a pool of 
+                               threads, e.g. a ProcessPoolExecutor.
+        @returns    nothing.
+        """
+        self.pipe = Pipe(pipe_name)
+        self.functions = functions
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(workers)
+
+
+    def listen(self):
+        """
+        @brief Blocks until a client is connected.
+        """
+        self.pipe.listen()
+
+
+    def serve(self):
+        """
+        @brief Serves calls until the client closes the pipe.
+        """
+        while True:
+            try:
+                request_id, name, args, kwargs = self.pipe.recv_whatever()
+            except IOError:
+                break
+            function = self.functions.get(name)
+            if function is None:
+                self.respond(request_id, False, ValueError('Unknown function ' + str(name) + '.'))
+                continue
+            future = self.executor.submit(function, *args, **kwargs)
+            future.add_done_callback(lambda f, request_id=request_id: self.reply(request_id, f))
+        self.executor.shutdown(wait=True)
+
+
+    def reply(self, request_id, future):
+        if future.exception() is None:
+            self.respond(request_id, True, future.result())
+        else:
+            self.respond(request_id, False, future.exception())
+
+
+    def respond(self, request_id, ok, value):
+        try:
+            self.pipe.send_whatever((request_id, ok, value))
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            # The result cannot be pickled
+            self.pipe.send_whatever((request_id, False, RuntimeError(repr(value) + ': ' + str(e))))
+        except BrokenPipeError:
+            # The client is gone
+            pass
+
+
+    def cleanup(self):
+        self.pipe.cleanup()
+
+
+class RpcClient:
+
+    def __init__(self, pipe_name):
+        """
+        @brief      Calls the functions of an RpcServer without waiting for each response.
+        @param[in]  pipe_name  String with the name of the pipe, same for server and client.
+        @returns    nothing.
+        """
+        self.pipe = Pipe(pipe_name)
+        self.request_ids = itertools.count()
+        self.futures = {}
+        self.futures_lock = threading.Lock()
+        self.reader = None
+
+
+    def connect(self):
+        """
+        @brief Blocks until the server is listening, and starts the thread that receives 
+               the responses.
+        """
+        self.pipe.connect()
+        self.reader = threading.Thread(target=self.read_responses, daemon=True)
+        self.reader.start()
+
+
+    def call(self, name, *args, **kwargs):
+        """
+        @brief      Calls a function of the server.
+        @param[in]  name  Name of the function.
+        @returns    a concurrent.futures.Future with the result of the call. Exceptions 
+                    raised by the function are raised by its result().
+        """
+        future = concurrent.futures.Future()
+        with self.futures_lock:
+            request_id = next(self.request_ids)
+            self.futures[request_id] = future
+        try:
+            self.pipe.send_whatever((request_id, name, args, kwargs))
+        except Exception:
+            with self.futures_lock:
+                del self.futures[request_id]
+            raise
+        return future
+
+
+    def read_responses(self):
+        """
+        @brief Thread that completes the futures of the calls as the responses arrive.
+        """
+        while True:
+            try:
+                request_id, ok, value = self.pipe.recv_whatever()
+            except IOError as e:
+                # The pipe is closed, the calls in flight are never going to finish
+                with self.futures_lock:
+                    futures, self.futures = self.futures, {}
+                for future in futures.values():
+                    future.set_exception(IOError('The RPC server closed the pipe: ' + str(e)))
+                return
+            with self.futures_lock:
+                future = self.futures.pop(request_id)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+    def cleanup(self):
+        self.pipe.cleanup()
+
 
 if __name__ == "__main__":
     raise RuntimeError('The EasyIPC module is not a script and such not be executed as such.')
@@ -6,12 +6,28 @@
 
 import unittest
 import os
+import socket
+import struct
+import dataclasses
 import sys
 import numpy as np
+import asyncio
+import array
+import tempfile
+import threading
+import time
 
 # My imports
 import easyipc
 
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: float
+    label: bytes
+
+
 class TestEasyIPC(unittest.TestCase):
     
     def test_pipe(self):
@@ -23,6 +39,7 @@ class TestEasyIPC(unittest.TestCase):
             client.send_whatever({'Hello': 'from the client'})
             for i in range(len(data)):
                 client.send_array(data[i])
+            os._exit(0)
         else:
             server = easyipc.Pipe('hoho')
             server.listen()
@@ -36,6 +53,847 @@ class TestEasyIPC(unittest.TestCase):
                 data_back = server.recv_array()
                 self.assertTrue(np.sum(data[i] - data_back) == 0)
 
+    def test_pipe_whatever_out_of_band(self):
+        data = {'frame': np.random.rand(200, 300), 'meta': {'id': 7, 'name': 'frame'}, 
+            'masks': [np.random.rand(300, 300) > 0.5 for i in range(3)], 
+            'small': np.arange(10), 'transposed': np.random.rand(200, 300).T}
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_oob')
+            client.connect()
+            client.send_whatever(data)
+            client.send_whatever('done')
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_oob')
+            server.listen()
+            data_back = server.recv_whatever()
+            self.assertTrue(data_back['meta'] == data['meta'])
+            for key in ['frame', 'small', 'transposed']:
+                self.assertTrue(np.array_equal(data[key], data_back[key]))
+            for mask, mask_back in zip(data['masks'], data_back['masks']):
+                self.assertTrue(np.array_equal(mask, mask_back))
+            self.assertTrue(data_back['frame'].flags.writeable)
+            self.assertTrue(server.recv_whatever() == 'done')
+            os.waitpid(newpid, 0)
+
+    def test_pipe_array_zero_copy(self):
+        data = [np.random.rand(300, 300)[::2, 1:], np.zeros((0, 3)), np.array(3.5),
+            np.array(['2020-01-01', '2020-06-25'], dtype='M8[D]'), 
+            np.arange(12, dtype='>f8').reshape(3, 4), np.asfortranarray(np.random.rand(30, 40)),
+            np.zeros((2, ) * 20, dtype=np.uint8), 
+            np.array([(1, 2.5, b'ab')], dtype=[('a', '<i4'), ('b', '>f8'), ('c', 'S2')])]
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_zero_copy')
+            client.connect()
+            for i in range(len(data)):
+                client.send_array(data[i])
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_zero_copy')
+            server.listen()
+            for i in range(len(data)):
+                data_back = server.recv_array()
+                self.assertTrue(np.array_equal(data[i], data_back))
+                self.assertTrue(data_back.dtype == data[i].dtype)
+                self.assertTrue(data_back.flags.f_contiguous == data[i].flags.f_contiguous)
+                self.assertTrue(data_back.flags.writeable)
+            os.waitpid(newpid, 0)
+
+    def test_pipe_recv_array_out_and_pool(self):
+        data = [np.random.rand(100, 100), np.random.rand(100, 100), np.random.rand(10, 10),
+            np.random.rand(100, 100)]
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_pool')
+            client.connect()
+            for i in range(len(data)):
+                client.send_array(data[i])
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_pool', pool_size=10 ** 6)
+            server.listen()
+
+            # Receive into an array provided by us
+            out = np.empty((100, 100))
+            self.assertTrue(server.recv_array(out=out) is out)
+            self.assertTrue(np.array_equal(data[0], out))
+
+            # Received arrays that are given back are reused
+            server.recycle(out)
+            data_back = server.recv_array()
+            self.assertTrue(data_back is out)
+            self.assertTrue(np.array_equal(data[1], data_back))
+
+            # The shape of out must match
+            self.assertRaises(ValueError, server.recv_array, out=np.empty((3, 3)))
+
+            # The rejected array does not get in the way of the next one
+            self.assertTrue(np.array_equal(data[3], server.recv_array()))
+            os.waitpid(newpid, 0)
+
+    def test_buffer_pool_eviction(self):
+        pool = easyipc.easyipc.BufferPool(3 * 800)
+        a, b, c = np.empty(100), np.empty(100), np.empty(100, dtype=np.int64)
+        pool.put(a)
+        pool.put(c)
+        pool.put(b)
+        self.assertTrue(pool.get((100,), np.float64) is b)
+        pool.put(b)
+
+        # Giving back the same array twice keeps a single copy
+        pool.put(b)
+        self.assertTrue(pool.nbytes == 3 * 800)
+        pool.put(np.empty(100, dtype=np.int32))
+        pool.put(np.empty(100, dtype=np.int32))
+
+        # The int64 array is the least recently used, so it is the first one to go
+        self.assertTrue(pool.get((100,), np.int64) is None)
+        self.assertTrue(pool.nbytes <= 3 * 800)
+
+    def test_pipe_array_stream(self):
+        data = np.random.rand(100, 50, 3).astype(np.float32)
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_stream')
+            client.connect()
+            client.send_array_stream(data.shape, data.dtype, (data[i:i + 7] for i in range(0, 100, 7)))
+            client.send_array_stream(data.shape, data.dtype, iter(data.reshape(-1, 10)))
+            client.send_array(data)
+            client.send_whatever('done')
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_stream')
+            server.listen()
+
+            # Chunks of whole rows that fit in the requested size
+            chunks = [chunk.copy() for chunk in server.recv_array_stream(chunk_bytes=50 * 3 * 4 * 8)]
+            self.assertTrue(all(chunk.shape[0] <= 8 for chunk in chunks))
+            self.assertTrue(np.array_equal(np.concatenate(chunks), data))
+
+            # Directly into a memory-mapped file
+            with tempfile.TemporaryFile() as f:
+                out = np.memmap(f, dtype=np.float32, shape=data.shape, mode='w+')
+                for chunk in server.recv_array_stream(chunk_bytes=10000, out=out):
+                    pass
+                self.assertTrue(np.array_equal(out, data))
+
+            # Stopping early discards the rest of the array
+            for chunk in server.recv_array_stream(chunk_bytes=10000):
+                break
+            self.assertTrue(server.recv_whatever() == 'done')
+            os.waitpid(newpid, 0)
+
+    def test_pipe_compression(self):
+        mask = np.zeros((512, 512), dtype=np.uint8)
+        mask[100:200, 300:400] = 1
+        noise = np.random.rand(256, 256).astype(np.float32)
+
+        # Masks are compressed, noise is sent as it is after compressing a sample
+        pipe = easyipc.Pipe('hoho_codec', compression='zlib')
+        self.assertTrue(len(pipe.encode_array(mask)[1]) < mask.nbytes // 10)
+        self.assertTrue(pipe.encode_array(noise)[1].nbytes == noise.nbytes)
+        with self.assertRaises(ValueError):
+            easyipc.Pipe('hoho_codec', compression='nonexistent')
+
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_codec', compression='zlib')
+            client.connect()
+            client.send_array(mask)
+            client.send_array(noise)
+            client.send_array(np.asfortranarray(mask))
+            client.send_whatever({'mask': mask, 'noise': noise})
+            client.send_many([mask, 'small', noise])
+            client.send_whatever('done')
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_codec')
+            server.listen()
+            self.assertTrue(np.array_equal(server.recv_array(), mask))
+            self.assertTrue(np.array_equal(server.recv_array(), noise))
+            out = np.empty_like(mask)
+            self.assertTrue(server.recv_array(out=out) is out and np.array_equal(out, mask))
+            data = server.recv_whatever()
+            self.assertTrue(np.array_equal(data['mask'], mask))
+            self.assertTrue(np.array_equal(data['noise'], noise))
+            items = []
+            while len(items) < 4:
+                items += server.recv_many()
+            self.assertTrue(np.array_equal(items[0], mask) and items[1] == 'small')
+            self.assertTrue(np.array_equal(items[2], noise) and items[3] == 'done')
+            os.waitpid(newpid, 0)
+
+    def test_pipe_close_async(self):
+        # Closing does not wait forever for an end that is not reading
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_close_async')
+            client.connect()
+            client.close_timeout = 0.2
+            client.send_array_async(np.zeros(1024 * 1024))
+            pending = client.send_array_async(np.zeros(10))
+            tic = time.monotonic()
+            client.cleanup()
+            ok = pending.cancelled() and time.monotonic() - tic < 5
+            os._exit(0 if ok else 1)
+        else:
+            server = easyipc.Pipe('hoho_close_async')
+            server.listen()
+            self.assertTrue(os.waitpid(newpid, 0)[1] == 0)
+            server.cleanup()
+
+    def test_pipe_send_recv_threads(self):
+        # Each end sends from one thread while another receives, with full pipes
+        data = np.random.rand(1024 * 1024)
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_threads')
+            client.connect()
+            sender = threading.Thread(target=client.send_array, args=(data, ))
+            sender.start()
+            ok = np.array_equal(client.recv_array(), data)
+            sender.join()
+            os._exit(0 if ok else 1)
+        else:
+            server = easyipc.Pipe('hoho_threads')
+            server.listen()
+            sender = threading.Thread(target=server.send_array, args=(data, ))
+            sender.start()
+            self.assertTrue(np.array_equal(server.recv_array(), data))
+            sender.join()
+            self.assertTrue(os.waitpid(newpid, 0)[1] == 0)
+
+    def test_pipe_send_async(self):
+        arrays = [np.full((128, 128), i, dtype=np.int32) for i in range(20)]
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_async_send', async_queue_size=4)
+            client.connect()
+            futures = [client.send_array_async(a) for a in arrays]
+            futures.append(client.send_async({'last': True}))
+            client.send_whatever('sync')
+            client.flush()
+            client.send_whatever(all(f.done() and f.exception() is None for f in futures))
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_async_send')
+            server.listen()
+            for a in arrays:
+                self.assertTrue(np.array_equal(server.recv_array(), a))
+            self.assertTrue(server.recv_whatever() == {'last': True})
+            self.assertTrue(server.recv_whatever() == 'sync')
+            self.assertTrue(server.recv_whatever())
+            os.waitpid(newpid, 0)
+
+        # Backpressure when nobody reads the other end
+        with self.assertRaises(ValueError):
+            easyipc.Pipe('hoho_async_full', backpressure='nonexistent')
+        big = np.zeros(1024 * 1024, dtype=np.uint8)
+        for policy in ('raise', 'drop_oldest'):
+            newpid = os.fork()
+            if newpid == 0:
+                server = easyipc.Pipe('hoho_async_full')
+                server.listen()
+                time.sleep(60)
+                os._exit(0)
+            client = easyipc.Pipe('hoho_async_full', async_queue_size=2, backpressure=policy)
+            client.connect()
+            futures = [client.send_array_async(big)]
+            while not futures[0].running():
+                pass
+            futures += [client.send_array_async(big) for _ in range(2)]
+            if policy == 'raise':
+                with self.assertRaises(BlockingIOError):
+                    client.send_array_async(big)
+            else:
+                futures.append(client.send_array_async(big))
+                self.assertTrue(futures[1].cancelled() and not futures[2].cancelled())
+            os.kill(newpid, 9)
+            os.waitpid(newpid, 0)
+            client.cleanup()
+            self.assertTrue(isinstance(futures[0].exception(), BrokenPipeError))
+
+    def test_pipe_prefetch(self):
+        arrays = [np.full((64, 64), i, dtype=np.float32) for i in range(10)]
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_prefetch')
+            client.connect()
+            for a in arrays:
+                client.send_array(a)
+            client.recv_whatever()
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_prefetch')
+            server.listen()
+            server.start_prefetch(depth=3)
+            with self.assertRaises(ValueError):
+                server.recv_whatever()
+
+            # The reader thread stops when the queue is full
+            deadline = time.monotonic() + 5
+            while server.prefetch_depth() < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            time.sleep(0.05)
+            self.assertTrue(server.prefetch_depth() == 3)
+
+            out = np.empty((64, 64), dtype=np.float32)
+            self.assertTrue(server.recv_array(out=out) is out and np.array_equal(out, arrays[0]))
+            for a in arrays[1:]:
+                self.assertTrue(np.array_equal(server.recv_array(), a))
+            self.assertTrue(server.recv_array(blocking=False) is None)
+            self.assertTrue(server.recv_prefetched('array', timeout=0.05) is None)
+            server.send_whatever('bye')
+            os.waitpid(newpid, 0)
+
+            # The error of the reader thread reaches the consumer
+            with self.assertRaises(IOError):
+                server.recv_array()
+
+    def test_pipe_selector(self):
+        names = ['hoho_select' + str(i) for i in range(3)]
+        newpid = os.fork()
+        if newpid == 0:
+            clients = [easyipc.Pipe(name) for name in names]
+            for client in clients:
+                client.connect()
+            clients[0].recv_whatever()
+            clients[1].send_whatever('one')
+            clients[2].send_array(np.arange(3))
+            clients[0].recv_whatever()
+            os._exit(0)
+        else:
+            servers = [easyipc.Pipe(name) for name in names]
+            for server in servers:
+                server.listen()
+            selector = easyipc.PipeSelector(servers)
+
+            # Nothing to read
+            tic = time.monotonic()
+            self.assertTrue(selector.select(timeout=0.05) == [])
+            self.assertTrue(servers[1].recv_whatever(timeout=0.05) is None)
+            self.assertTrue(servers[2].recv_array(timeout=0.05) is None)
+            self.assertTrue(servers[1].recv_whatever(blocking=False) is None)
+            self.assertTrue(time.monotonic() - tic >= 0.15)
+
+            servers[0].send_whatever('go')
+            ready = []
+            while len(ready) < 2:
+                for pipe in selector.select(timeout=5):
+                    ready.append(pipe)
+                    selector.unregister(pipe)
+            self.assertTrue(set(map(id, ready)) == {id(servers[1]), id(servers[2])})
+            self.assertTrue(servers[1].recv_whatever(timeout=1) == 'one')
+            self.assertTrue(np.array_equal(servers[2].recv_array(timeout=1), np.arange(3)))
+            self.assertTrue(easyipc.wait(servers, timeout=0) == [])
+            selector.close()
+            servers[0].send_whatever('bye')
+            os.waitpid(newpid, 0)
+
+    def test_broadcast(self):
+        def subscriber(name, frames, min_skipped=0, delay=0):
+            sub = easyipc.Subscriber(name)
+            sub.connect()
+            ok = True
+            for _ in range(frames):
+                data = sub.recv()
+                ok = ok and data.shape == (100, 100) and np.all(data == sub.seq)
+                time.sleep(delay)
+                sub.release(data)
+            os._exit(0 if ok and sub.skipped >= min_skipped else 1)
+
+        # Every subscriber gets every frame
+        broadcaster = easyipc.Broadcaster('hoho_bcast', depth=2, policy='block')
+        broadcaster.listen()
+        pids = []
+        for _ in range(2):
+            pid = os.fork()
+            if pid == 0:
+                subscriber('hoho_bcast', 10)
+            pids.append(pid)
+        self.assertTrue(broadcaster.wait_subscribers(2, timeout=5))
+        for i in range(10):
+            self.assertTrue(broadcaster.publish(np.full((100, 100), i, dtype=np.float32)) == 2)
+        for pid in pids:
+            self.assertTrue(os.waitpid(pid, 0)[1] == 0)
+        self.assertTrue(len(broadcaster.segments) <= 3)
+        broadcaster.cleanup()
+
+        # A slow subscriber skips to the latest frame
+        broadcaster = easyipc.Broadcaster('hoho_bcast_latest', depth=1, policy='latest')
+        broadcaster.listen()
+        pid = os.fork()
+        if pid == 0:
+            subscriber('hoho_bcast_latest', 2, min_skipped=3, delay=0.2)
+        self.assertTrue(broadcaster.wait_subscribers(1, timeout=5))
+        counts = [broadcaster.publish(np.full((100, 100), i, dtype=np.int64)) for i in range(4)]
+        self.assertTrue(counts == [1, 0, 0, 0])
+        while broadcaster.publish(np.full((100, 100), broadcaster.seq, dtype=np.int64)) == 0:
+            time.sleep(0.01)
+        self.assertTrue(os.waitpid(pid, 0)[1] == 0)
+        broadcaster.cleanup()
+
+    def test_rpc(self):
+        def work(x, delay=0):
+            time.sleep(delay)
+            if x < 0:
+                raise ValueError('negative')
+            return x * 2
+
+        newpid = os.fork()
+        if newpid == 0:
+            server = easyipc.RpcServer('hoho_rpc', {'work': work, 'double': lambda a: a * 2})
+            server.listen()
+            server.serve()
+            os._exit(0)
+        else:
+            client = easyipc.RpcClient('hoho_rpc')
+            client.connect()
+
+            # The slow call does not hold the others back
+            slow = client.call('work', 1, delay=0.5)
+            fast = [client.call('work', i) for i in range(10)]
+            self.assertTrue([f.result(timeout=5) for f in fast] == [2 * i for i in range(10)])
+            self.assertFalse(slow.done())
+            self.assertTrue(slow.result(timeout=5) == 2)
+
+            with self.assertRaises(ValueError):
+                client.call('work', -1).result(timeout=5)
+            with self.assertRaises(ValueError):
+                client.call('nonexistent').result(timeout=5)
+            self.assertTrue(np.array_equal(client.call('double', np.arange(5)).result(timeout=5), 
+                np.arange(5) * 2))
+            client.cleanup()
+            os.waitpid(newpid, 0)
+
+    def test_pipe_stats(self):
+        self.assertTrue(easyipc.Pipe('hoho_stats').stats() is None)
+        data = np.random.rand(256, 256)
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_stats')
+            client.connect()
+            client.send_array(data)
+            client.send_whatever({'hello': 'world'})
+            os._exit(0)
+        else:
+            samples = []
+            server = easyipc.Pipe('hoho_stats', stats_hook=lambda name, ns: samples.append(name))
+            server.listen()
+            server.recv_array()
+            server.recv_whatever()
+            os.waitpid(newpid, 0)
+            stats = server.stats()
+            self.assertTrue(stats['messages_received'] == 2 and stats['messages_sent'] == 0)
+            self.assertTrue(stats['bytes_received'] > data.nbytes)
+            self.assertTrue(stats['read_calls'] >= 4 and stats['read_blocked_ns'] > 0)
+            self.assertTrue(stats['unpickle_ns'] > 0 and stats['header_decode_ns'] > 0)
+            self.assertTrue(sum(stats['histograms']['read_blocked_ns'].values()) == stats['read_calls'])
+            self.assertTrue(samples.count('read_blocked_ns') == stats['read_calls'])
+
+    def test_pipe_spin(self):
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_spin')
+            client.connect()
+            ok = client.recv_whatever() == 'go'
+            for i in range(10):
+                client.send_whatever(i)
+            client.send_array(np.arange(10))
+            os._exit(0 if ok else 1)
+        else:
+            server = easyipc.Pipe('hoho_spin', spin=0.5, stats=True)
+            server.listen()
+            self.assertTrue(server.recv_whatever(timeout=0.01) is None)
+            server.send_whatever('go')
+            self.assertTrue([server.recv_whatever() for i in range(10)] == list(range(10)))
+            self.assertTrue(np.array_equal(server.recv_array(timeout=1), np.arange(10)))
+            self.assertTrue(os.waitpid(newpid, 0)[1] == 0)
+            stats = server.stats()
+            self.assertTrue(stats['spin_misses'] == 1 and stats['spin_hits'] == 11)
+            self.assertTrue(sum(stats['histograms']['wait_ns'].values()) == 12)
+
+    def test_pipe_serializer(self):
+        serializer = easyipc.struct_serializer(1000, Point, '<qd4s')
+        easyipc.register_serializer(serializer)
+        self.addCleanup(easyipc.unregister_serializer, serializer)
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_serializer')
+            client.connect()
+            client.send_whatever(Point(1, 2.5, b'abcd'))
+            client.send_whatever(Point(1.5, 2.5, b'abcd'))
+            easyipc.register_serializer(easyipc.Serializer(1001, complex, 
+                lambda c: struct.pack('<dd', c.real, c.imag), None))
+            client.send_whatever(1 + 2j)
+            client.send_many([Point(i, 0.5, b'many') for i in range(3)] + ['done'])
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_serializer')
+            server.listen()
+            self.assertTrue(server.recv_whatever() == Point(1, 2.5, b'abcd'))
+
+            # Objects that do not fit the layout are pickled
+            self.assertTrue(server.recv_whatever() == Point(1.5, 2.5, b'abcd'))
+
+            # Tags unknown to this end raise, but the pipe stays usable
+            with self.assertRaises(ValueError):
+                server.recv_whatever()
+            items = []
+            while len(items) < 4:
+                items += server.recv_many()
+            self.assertTrue(items == [Point(i, 0.5, b'many') for i in range(3)] + ['done'])
+            os.waitpid(newpid, 0)
+
+    def test_pipe_credit(self):
+        big = np.random.rand(512, 512)
+        newpid = os.fork()
+        if newpid == 0:
+            shed = []
+            def hook(pipe):
+                if not shed:
+                    shed.append(pipe.credit())
+                    raise BlockingIOError
+            client = easyipc.Pipe('hoho_credit', window_messages=2, window_bytes=1 << 20,
+                credit_hook=hook, stats=True)
+            client.connect()
+            ok = client.credit() == (2, 1 << 20)
+            client.send_whatever(0)
+            client.send_whatever(1)
+            ok = ok and client.credit()[0] == 0
+
+            # The hook drops the first message sent without credit, the rest wait
+            try:
+                client.send_whatever(-1)
+                ok = False
+            except BlockingIOError:
+                ok = ok and shed == [(0, (1 << 20) - client.stats()['bytes_sent'])]
+            for i in range(2, 10):
+                client.send_whatever(i)
+            for i in range(3):
+                client.send_array(big)
+            client.send_many(range(10, 20))
+            ok = ok and client.credit()[0] >= 0
+            stats = client.stats()
+            ok = ok and stats['credit_exhausted'] >= 3 and stats['credit_wait_ns'] > 0
+            ok = ok and client.recv_whatever() == 'done'
+            os._exit(0 if ok else 1)
+        else:
+            server = easyipc.Pipe('hoho_credit', window_messages=2, window_bytes=1 << 20)
+            server.listen()
+            time.sleep(0.2)
+            self.assertTrue([server.recv_whatever() for i in range(10)] == list(range(10)))
+            for i in range(3):
+                self.assertTrue(np.array_equal(server.recv_array(), big))
+            items = []
+            while len(items) < 10:
+                items += server.recv_many()
+            self.assertTrue(items == list(range(10, 20)))
+            server.send_whatever('done')
+            self.assertTrue(os.waitpid(newpid, 0)[1] == 0)
+
+    def test_bench(self):
+        from easyipc import bench
+        report = bench.run(['pipe_array', 'mp_pipe'], min_size=64, max_size=1024, 
+            bytes_per_point=1024, max_iterations=20)
+        self.assertTrue([(r['transport'], r['size']) for r in report['results']] == 
+            [(t, s) for s in (64, 256, 1024) for t in ('pipe_array', 'mp_pipe')])
+        for result in report['results']:
+            self.assertTrue(result['iterations'] >= 5 and result['throughput_MBps'] > 0)
+            self.assertTrue(result['rtt_p50_us'] <= result['rtt_p99_us'] <= result['rtt_p999_us'])
+
+    def test_pipe_fixed_array_stream(self):
+        frames = [np.full((108, 192, 3), i, dtype=np.uint8) for i in range(10)]
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_fixed_stream')
+            client.connect()
+            stream = client.open_array_stream((108, 192, 3), np.uint8, depth=3)
+            for frame in frames:
+                stream.send(frame)
+            try:
+                stream.send(frames[0].astype(np.float32))
+            except ValueError:
+                stream.close()
+            client.send_whatever('done')
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_fixed_stream')
+            server.listen()
+            stream = server.accept_array_stream()
+            received = []
+            for frame in stream:
+                received.append(frame)
+                self.assertTrue(np.array_equal(frame, frames[stream.seq]))
+            self.assertTrue(len(received) == 10)
+
+            # The receiver cycles through 'depth' buffers
+            self.assertTrue(received[0] is received[3] and received[0] is not received[1])
+            self.assertTrue(server.recv_whatever() == 'done')
+            os.waitpid(newpid, 0)
+
+    def test_pipe_stripes(self):
+        big = np.random.rand(1024, 2048).astype(np.float32)
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_stripes', stripes=4)
+            client.connect()
+            client.send_array(big)
+            client.send_array(np.asfortranarray(big))
+            client.send_array(big[:4])
+            client.send_whatever({'big': big})
+            client.send_array(big)
+            client.send_array_async(big).result()
+            ok = client.recv_whatever() == 'done'
+            os._exit(0 if ok else 1)
+        else:
+            server = easyipc.Pipe('hoho_stripes', stripes=4)
+            server.listen()
+            self.assertTrue(np.array_equal(server.recv_array(), big))
+            data = server.recv_array()
+            self.assertTrue(data.flags.f_contiguous and np.array_equal(data, big))
+            self.assertTrue(np.array_equal(server.recv_array(), big[:4]))
+            self.assertTrue(np.array_equal(server.recv_whatever()['big'], big))
+
+            # A body that does not fit in 'out' is discarded from all the stripes
+            with self.assertRaises(ValueError):
+                server.recv_array(out=np.empty(3))
+            out = np.empty_like(big)
+            self.assertTrue(server.recv_array(out=out) is out and np.array_equal(out, big))
+            server.send_whatever('done')
+            self.assertTrue(os.waitpid(newpid, 0)[1] == 0)
+
+    def test_tcp(self):
+        # Free ports of the loopback interface
+        ports = []
+        for _ in range(2):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.bind(('127.0.0.1', 0))
+            ports.append(sock.getsockname()[1])
+            sock.close()
+
+        # A server per port that doubles the arrays and echoes the rest
+        pids = []
+        for port in ports:
+            newpid = os.fork()
+            if newpid == 0:
+                server = easyipc.TcpPipe('127.0.0.1', port)
+                server.listen()
+                server.send_array(server.recv_array() * 2)
+                server.send_array(server.recv_array(timeout=10) * 2)
+                server.send_whatever(server.recv_whatever())
+                server.cleanup()
+                os._exit(0)
+            pids.append(newpid)
+
+        pool = easyipc.TcpPipePool(connect_timeout=10)
+        data = np.random.rand(500, 700)
+        for port in ports:
+            client = pool.get('127.0.0.1', port)
+            self.assertTrue(pool.get('127.0.0.1', port) is client)
+            client.send_array(data)
+            self.assertTrue(np.array_equal(client.recv_array(), data * 2))
+            client.send_array(np.asfortranarray(data[:3]))
+            self.assertTrue(np.array_equal(client.recv_array(), data[:3] * 2))
+            client.send_whatever({'port': port, 'data': data})
+            message = client.recv_whatever()
+            self.assertTrue(message['port'] == port and np.array_equal(message['data'], data))
+        for newpid in pids:
+            self.assertTrue(os.waitpid(newpid, 0)[1] == 0)
+        pool.cleanup()
+        self.assertTrue(not pool.pipes)
+
+    def test_pipe_buffer(self):
+        big = np.random.randint(0, 256, 1024 * 1024, dtype=np.uint8).tobytes()
+        grid = memoryview(np.arange(12, dtype=np.float64).reshape(3, 4))
+        dates = np.array(['2020-06-24', '2020-06-25'], dtype='datetime64[D]')
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_buffer')
+            client.connect()
+            client.send_buffer(b'jpeg')
+            client.send_buffer(big)
+            client.send_buffer(bytearray(b'abc'))
+            client.send_buffer(array.array('i', [1, 2, 3]))
+            client.send_buffer(grid)
+            client.send_buffer(dates)
+            client.send_buffer(np.arange(10)[::2])
+            client.send_buffer(big)
+            try:
+                client.send_buffer(object())
+            except ValueError:
+                client.send_whatever('done')
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_buffer')
+            server.listen()
+            self.assertTrue(server.recv_buffer() == b'jpeg')
+            self.assertTrue(server.recv_buffer() == big)
+            data = server.recv_buffer()
+            self.assertTrue(type(data) is bytearray and data == b'abc')
+            self.assertTrue(server.recv_buffer() == array.array('i', [1, 2, 3]))
+            data = server.recv_buffer()
+            self.assertTrue(data.format == 'd' and data.shape == (3, 4) and data.tolist() == grid.tolist())
+            self.assertTrue(np.array_equal(server.recv_buffer(), dates))
+            self.assertTrue(np.array_equal(server.recv_buffer(), np.arange(10)[::2]))
+            data = server.recv_buffer(raw=True)
+            self.assertTrue(isinstance(data, memoryview) and data == big)
+            self.assertTrue(server.recv_whatever() == 'done')
+            os.waitpid(newpid, 0)
+
+    def test_shared_memory_pipe(self):
+        # Slots are rounded up so that every slot is aligned for any dtype
+        self.assertTrue(easyipc.SharedMemoryPipe('hoho_shm', slot_size=1000).slot_size % 4096 == 0)
+
+        data = [np.random.rand(32, 32).astype(np.float32) for i in range(10)]
+        big = np.random.rand(20, 20)
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.SharedMemoryPipe('hoho_shm', slots=2, slot_size=4096)
+            client.connect()
+            for i in range(len(data)):
+                client.send_array(data[i])
+            client.send_array(big)
+            client.cleanup()
+            os._exit(0)
+        else:
+            server = easyipc.SharedMemoryPipe('hoho_shm', slots=2, slot_size=4096)
+            server.listen()
+
+            # Pipe sends arrays in a different way, so its array helpers are not available
+            self.assertRaises(ValueError, server.send_array_async, np.ones(3))
+            self.assertRaises(ValueError, server.start_prefetch)
+
+            # Slots of arrays rejected by out are released, otherwise the client would block
+            for i in range(3):
+                self.assertRaises(ValueError, server.recv_array, out=np.empty((3, 3)))
+            # Releasing twice does not give the slot to two arrays
+            data_back = server.recv_array()
+            self.assertTrue(np.array_equal(data[3], data_back))
+            server.release(data_back)
+            server.release(data_back)
+            for i in range(4, len(data), 2):
+                pair = [server.recv_array(), server.recv_array()]
+                self.assertTrue(np.array_equal(data[i], pair[0]))
+                self.assertTrue(np.array_equal(data[i + 1], pair[1]))
+                for data_back in pair:
+                    server.release(data_back)
+            self.assertTrue(np.array_equal(big, server.recv_array()))
+            os.waitpid(newpid, 0)
+
+    def test_pipe_send_many_recv_many(self):
+        messages = [{'id': i, 'value': float(i)} for i in range(1000)]
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_many', flush_bytes=4096, flush_delay=0.01)
+            client.connect()
+            client.send_many(messages[:500])
+            for message in messages[500:]:
+                client.send_whatever(message)
+            client.send_array(np.arange(10))
+            client.recv_whatever()
+
+            # Queued messages are written when the pipe is closed
+            client.flush_delay = 60
+            client.send_whatever('last')
+            client.cleanup()
+            os._exit(0)
+        else:
+            server = easyipc.Pipe('hoho_many')
+            server.listen()
+            received = []
+            while len(received) < len(messages):
+                received += server.recv_many(max_items=len(messages) - len(received), timeout=5)
+            self.assertTrue(received == messages)
+            self.assertTrue(np.array_equal(server.recv_array(), np.arange(10)))
+            self.assertTrue(server.recv_many(timeout=0.01) == [])
+            server.send_whatever('bye')
+            self.assertTrue(server.recv_whatever() == 'last')
+            os.waitpid(newpid, 0)
+
+    def test_async_pipe(self):
+        data = [np.random.rand(300, 300) for i in range(3)]
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.Pipe('hoho_async')
+            client.connect()
+            for i in range(len(data)):
+                client.send_array(data[i])
+                client.send_whatever({'index': i})
+            ok = client.recv_whatever() == 'bye'
+            os._exit(0 if ok else 1)
+        else:
+            async def serve():
+                server = easyipc.AsyncPipe('hoho_async')
+                await server.listen()
+                for i in range(len(data)):
+                    self.assertTrue(np.array_equal(data[i], await server.recv_array()))
+                    self.assertTrue((await server.recv_whatever())['index'] == i)
+                await server.send_whatever('bye')
+            asyncio.run(serve())
+            self.assertTrue(os.waitpid(newpid, 0)[1] == 0)
+
+    def test_unix_socket_pipe(self):
+        data = [np.random.rand(10, 10), np.random.rand(500, 500).astype(np.float32)]
+        newpid = os.fork()
+        if newpid == 0:
+            client = easyipc.UnixSocketPipe('hoho_unix', memfd_threshold=4096)
+            client.connect()
+            client.send_whatever({'Hello': 'from the client'})
+            for i in range(len(data)):
+                client.send_array(data[i])
+            ok = client.recv_whatever() == 'bye'
+            os._exit(0 if ok else 1)
+        else:
+            server = easyipc.UnixSocketPipe('hoho_unix', memfd_threshold=4096)
+            server.listen()
+
+            # Pipe sends arrays in a different way, so its array helpers are not available
+            self.assertRaises(ValueError, server.send_array_async, np.ones(3))
+            self.assertRaises(ValueError, server.start_prefetch)
+            self.assertTrue(server.recv_whatever()['Hello'] == 'from the client')
+            for i in range(len(data)):
+                data_back = server.recv_array()
+                self.assertTrue(np.array_equal(data[i], data_back))
+                self.assertTrue(data_back.flags.writeable)
+            server.send_whatever('bye')
+            self.assertTrue(os.waitpid(newpid, 0)[1] == 0)
+
+    def test_pipe_server(self):
+        server = easyipc.PipeServer('hoho_server')
+        server.listen()
+        server.accept_timeout = 0.1
+
+        # A client that dies after writing its name does not stop the server
+        rendezvous = os.open(easyipc.PipeServer.rendezvous_name('hoho_server'), os.O_WRONLY)
+        os.write(rendezvous, b'hoho_server_dead\n')
+        os.close(rendezvous)
+        pids = []
+        for i in range(3):
+            newpid = os.fork()
+            if newpid == 0:
+                client = easyipc.PipeClient('hoho_server')
+                client.connect()
+                ok = True
+                for j in range(2):
+                    client.send_whatever({'client': i, 'request': j, 'data': np.ones(50000) * i})
+                    ok = ok and client.recv_whatever() == (i, j)
+                client.cleanup()
+                os._exit(0 if ok else 1)
+            pids.append(newpid)
+
+        # Reply to every request of every client
+        for k in range(6):
+            client_id, message = server.recv(timeout=10)
+            self.assertTrue(np.all(message['data'] == message['client']))
+            server.send_whatever(client_id, (message['client'], message['request']))
+        for newpid in pids:
+            self.assertTrue(os.waitpid(newpid, 0)[1] == 0)
+        self.assertTrue(server.recv(timeout=0.1) is None)
+        server.cleanup()
+
 
 if __name__ == '__main__':
     unittest.main()